@@ -0,0 +1,198 @@
+import time
+import asyncio
+import uuid
+import zmq
+import zmq.asyncio
+from client import (Client, proxy_socket, batch_results, BATCH_SIZE, PAGE_SIZE, PROXIES, CONSISTENCY,
+                    REVALIDATE_TIMEOUT)
+from metrics import REGISTRY as metrics
+from protocol import request_frames, decode, FORMATS, JSON
+
+
+class AsyncClient(Client):
+    """Pipelined client: many requests in flight on one socket, matched to replies by req_id.
+
+    Shares the local store and bookkeeping of Client; only the network side is async.
+    """
+
+    def __init__(self, proxy_addrs=PROXIES, max_in_flight=64, timeout=2.0, consistency=CONSISTENCY):
+        self._init_state(proxy_addrs, consistency)
+        self.ctx = zmq.asyncio.Context()
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.in_flight = {}  # req_id -> [future, message, proxy it went through]
+        self.socks = []
+        self.tasks = []
+
+    async def connect(self):
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        for i, addr in enumerate(self.proxies.addrs):
+            print(f"Connecting to proxy: {addr}...")
+            sock, monitor = proxy_socket(self.ctx, addr)
+            self.socks.append(sock)
+            self.tasks.append(asyncio.create_task(self._read_replies(sock)))
+            self.tasks.append(asyncio.create_task(self._watch(i, monitor)))
+
+        pongs = await asyncio.gather(*(self._ping(i) for i in range(len(self.socks))))
+        if not any(pongs):
+            await self.close()
+            raise Exception("Could not connect to any proxy.")
+        self.connected = True
+
+    async def _ping(self, i):
+        req_id = uuid.uuid4().hex
+        fut = asyncio.get_running_loop().create_future()
+        self.in_flight[req_id] = [fut, None, i]
+        await self.socks[i].send_multipart(request_frames({"op": "ping", "req_id": req_id, "formats": FORMATS}))
+        try:
+            resp = await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            print(f"Failed to connect to proxy: {self.proxies.addrs[i]}")
+            return False
+        finally:
+            self.in_flight.pop(req_id, None)
+        self.proxies.up.add(i)
+        self.proxies.formats[i] = resp.get("format", JSON)
+        print(f"Connected to proxy: {self.proxies.addrs[i]}")
+        return True
+
+    async def close(self):
+        tasks = self.tasks + list(self.revalidating.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for sock in self.socks:
+            sock.disable_monitor()
+            sock.close(linger=0)
+        self.tasks, self.socks = [], []
+        self.ctx.term()
+
+    async def _read_replies(self, sock):
+        while True:
+            try:
+                resp = decode(await sock.recv())
+            except ValueError:
+                # A damaged reply fails only the request it answered, which times out.
+                metrics.inc("client.bad_replies")
+                continue
+            waiting = self.in_flight.get(resp.get("req_id"))
+            # Replies with no waiting future belong to requests that already timed out.
+            if waiting is not None and not waiting[0].done():
+                waiting[0].set_result(resp)
+
+    async def _watch(self, i, monitor):
+        """Follow one proxy's connection. When it drops, resend what was waiting on it;
+        when it comes up, send what found no proxy up."""
+        try:
+            while True:
+                down = self.proxies.event(i, await monitor.recv_multipart())
+                for waiting in list(self.in_flight.values()):
+                    stranded = waiting[2] == i if down else waiting[2] is None
+                    if stranded and waiting[1] is not None and not waiting[0].done():
+                        await self._send(waiting)
+        finally:
+            monitor.close(linger=0)
+
+    async def _send(self, waiting):
+        via = self.proxies.pick()
+        if via is None:
+            return  # nowhere to go yet; _watch sends it when a proxy comes up
+        if waiting[2] is not None:
+            metrics.inc("client.resends")
+        waiting[2] = via
+        await self.socks[via].send_multipart(request_frames(waiting[1], self.proxies.format(via)))
+
+    async def request(self, msg, timeout=None):
+        """Send one message and wait for its reply; at most max_in_flight requests are outstanding."""
+        async with self.slots:
+            msg = self._traced(dict(msg, req_id=uuid.uuid4().hex))
+            req_id = msg["req_id"]
+            waiting = [asyncio.get_running_loop().create_future(), msg, None]
+            self.in_flight[req_id] = waiting
+            started = time.perf_counter()
+            try:
+                await self._send(waiting)
+                resp = await asyncio.wait_for(waiting[0], timeout or self.timeout)
+            except asyncio.TimeoutError:
+                resp = {"status": "timeout"}
+            finally:
+                self.in_flight.pop(req_id, None)
+            return self._record(msg, resp, started)
+
+    async def send_request(self, op, list_id, payload=None, timeout=None):
+        if payload is None:
+            payload = {}
+        return await self.request({"op": op, "list_id": list_id, "payload": payload}, timeout)
+
+    async def send_batch(self, ops, timeout=5.0):
+        """Like Client.send_batch, but every chunk is in flight at once."""
+        chunks = [ops[start:start + BATCH_SIZE] for start in range(0, len(ops), BATCH_SIZE)]
+        replies = await asyncio.gather(*(self.request({"op": "batch", "ops": chunk}, timeout) for chunk in chunks))
+        results = []
+        for chunk, resp in zip(chunks, replies):
+            results.extend(batch_results(resp, len(chunk)))
+        return results
+
+    async def create_list(self, list_id):
+        self.save_list_local(list_id)
+        return self._list_result(list_id, await self.send_request("create_list", list_id))
+
+    async def send_delta(self, list_id, item_name, delta):
+        return await self.send_request("merge", list_id, {"items": {item_name: delta}})
+
+    async def create_item(self, list_id, item_name, current, total):
+        delta, seq = self.save_item_local(list_id, item_name, current, total)
+        resp = await self.send_delta(list_id, item_name, delta)
+        return self._item_result(list_id, item_name, seq, resp)
+
+    async def update_item(self, list_id, item_name, current, total):
+        delta, seq = self.update_item_local(list_id, item_name, current, total)
+        resp = await self.send_delta(list_id, item_name, delta) if seq is not None else None
+        return self._item_result(list_id, item_name, seq, resp)
+
+    async def delete_item(self, list_id, item_name):
+        delta, seq = self.delete_item_local(list_id, item_name)
+        resp = await self.send_delta(list_id, item_name, delta) if seq is not None else None
+        return self._item_result(list_id, item_name, seq, resp)
+
+    async def get_info(self, list_id, consistency=None):
+        local = self.get_info_local(list_id)
+        copy = self._server_copy(list_id)
+        cached, revalidate = self._plan_read(copy, consistency or self.consistency)
+        if cached:
+            if revalidate and list_id not in self.revalidating:
+                self.revalidating[list_id] = asyncio.create_task(self._revalidate(list_id, copy))
+            return {"local": local, "server": self._from_copy(copy)}
+        generation = self.generations.get(list_id, 0)
+        server = await self.send_request("get_info", list_id, self._conditional(copy))
+        while server.get("next"):
+            page = await self.send_request("get_info", list_id, {"after": server.pop("next"), "limit": PAGE_SIZE})
+            server = self._add_page(server, page)
+        return {"local": local, "server": self._store_copy(list_id, copy, server, generation)}
+
+    async def _revalidate(self, list_id, copy):
+        generation = self.generations.get(list_id, 0)
+        try:
+            resp = await self.send_request("get_info", list_id, self._conditional(copy), REVALIDATE_TIMEOUT)
+            self._store_revalidated(list_id, copy, resp, generation)
+        finally:
+            del self.revalidating[list_id]
+
+    async def commit_all(self):
+        if not self._start_commit():
+            return True
+        after = 0
+        while True:
+            window = self._commit_ops(after)
+            if window is None:
+                return True
+            ops, acks, after = window
+            if not self._apply_commit(ops, acks, await self.send_batch(ops)):
+                return False
+
+    async def sync(self):
+        complete = more = True
+        while more:
+            more, answered = self._apply_changes(await self.send_request("changes_since", None, self._changes_request()))
+            complete = complete and answered
+        return complete
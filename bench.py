@@ -0,0 +1,383 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+import subprocess
+import multiprocessing
+import zmq
+import crdt
+from protocol import request_frames, decode, as_merge, ITEM_OPS
+
+# End-to-end benchmark. Starts proxies and servers on localhost as separate
+# processes, fills the store, replays a workload from concurrent clients and
+# reports throughput and latency per op.
+#
+# A workload is a sequence of requests as the client sends them, one JSON
+# object per line ({"op", "list_id", "payload"}). It is either synthetic (an
+# op mix over lists chosen with Zipf skew) or replayed from a file written by
+# --record or captured elsewhere. Item ops in a mix are sent the way the
+# client sends them: as merge requests carrying a CRDT delta.
+#
+# Per hop: ping is answered by the proxy itself, so a probe pinging during the
+# run measures client -> proxy -> client. The proxy's own view of each server
+# (latency, requests in flight, busy replies) comes from its "stats" op.
+#
+#   python bench.py --servers 3 --clients 8 --requests 20000 --mix get_info=0.8,update_item=0.2
+#   python bench.py --out base.json            # later: --baseline base.json
+
+BASE_PORT = 15558
+READY_TIMEOUT = 30
+PROBE_INTERVAL = 0.01
+SEED_REPLICA = "bench-seed"
+
+
+class Cluster:
+    """Proxies and servers running in a scratch directory."""
+
+    def __init__(self, proxies=1, servers=2, workers=1, base_port=BASE_PORT, durability="normal", proxy_args=()):
+        self.dir = tempfile.mkdtemp(prefix="bench-")
+        self.here = os.path.dirname(os.path.abspath(__file__))
+        self.ports = [(base_port + 2 * i, base_port + 2 * i + 1) for i in range(proxies)]
+        self.servers = servers
+        self.workers = workers
+        self.durability = durability
+        self.proxy_args = list(proxy_args)
+        self.procs = []
+        self.context = zmq.Context()
+
+    def _spawn(self, script, args, log):
+        out = open(os.path.join(self.dir, log), "w")
+        self.procs.append(subprocess.Popen([sys.executable, "-u", os.path.join(self.here, script)] + args,
+                                           cwd=self.dir, stdout=out, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL))
+
+    def start(self):
+        for i, (clients, servers) in enumerate(self.ports):
+            self._spawn("proxy.py", ["--clients", str(clients), "--servers", str(servers), "--name", f"Proxy {i + 1}",
+                                     "--workers", str(self.workers)] + self.proxy_args, f"proxy{i + 1}.log")
+        time.sleep(0.5)
+        proxies = []
+        for clients, servers in self.ports:
+            proxies += ["--proxy", f"tcp://localhost:{servers}"]
+        for i in range(self.servers):
+            self._spawn("server.py", ["--db", f"server{i + 1}.db", "--durability", self.durability] + proxies,
+                        f"server{i + 1}.log")
+        self.wait_ready()
+
+    def frontends(self):
+        return [f"tcp://localhost:{clients}" for clients, _ in self.ports]
+
+    def wait_ready(self):
+        deadline = time.time() + READY_TIMEOUT
+        while time.time() < deadline:
+            up = sum(sum(s["up"] for s in st.get("servers", {}).values()) for st in self.stats())
+            if up >= self.servers:
+                # Let the first rebalance go out before measuring.
+                time.sleep(2.5)
+                return
+            time.sleep(0.2)
+        raise Exception(f"Cluster not ready after {READY_TIMEOUT}s; logs in {self.dir}")
+
+    def stats(self):
+        """The stats reply of every proxy that answers."""
+        replies = []
+        for addr in self.frontends():
+            reply = call(self.context, addr, {"op": "stats"})
+            if reply.get("status") == "ok":
+                replies.append(reply)
+        return replies
+
+    def live_frontends(self):
+        """Proxies that have servers behind them; clients connect only to those."""
+        live = []
+        for addr in self.frontends():
+            reply = call(self.context, addr, {"op": "stats"})
+            if any(s["up"] for s in reply.get("servers", {}).values()):
+                live.append(addr)
+        return live
+
+    def stop(self, keep=False):
+        for p in self.procs:
+            p.terminate()
+        for p in self.procs:
+            try:
+                p.wait(5)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        self.context.term()
+        if keep:
+            print(f"Logs and stores kept in {self.dir}")
+        else:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def call(context, addr, msg, timeout=2.0):
+    sock = context.socket(zmq.DEALER)
+    sock.connect(addr)
+    try:
+        sock.send_multipart(request_frames(dict(msg, req_id="bench")))
+        if sock.poll(timeout * 1000):
+            return decode(sock.recv())
+        return {"status": "timeout"}
+    finally:
+        sock.close(linger=0)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        mix[op.strip()] = float(weight or 1)
+    return mix
+
+
+def seed_state(list_id, name):
+    """An item as seed_data creates it: 0 of 10."""
+    item = crdt.new_item()
+    return crdt.merge(item, crdt.add_delta(item, SEED_REPLICA, f"{SEED_REPLICA}:{list_id}/{name}", 0, 10))
+
+
+class Writer:
+    """One client replica's view of the items, kept in memory. Item ops become
+    merge requests with deltas made as Client.save_item_local, update_item_local
+    and delete_item_local make them. Items start as seed_data leaves them."""
+
+    def __init__(self, replica):
+        self.replica = replica
+        self.dots = itertools.count(1)
+        self.items = {}
+
+    def request(self, op, list_id, name, current, total):
+        item = self.items.get((list_id, name)) or seed_state(list_id, name)
+        if op == "create_item":
+            delta = crdt.add_delta(item, self.replica, f"{self.replica}:{next(self.dots)}", current, total)
+        elif op == "update_item":
+            delta = crdt.set_delta(item, self.replica, current, total)
+        else:
+            delta = crdt.remove_delta(item)
+        self.items[(list_id, name)] = crdt.merge(item, delta)
+        return as_merge(list_id, {name: delta})
+
+
+def synthetic(count, mix, lists, items, skew, seed):
+    """Requests with ops drawn from mix and lists drawn from a Zipf(skew) distribution."""
+    rng = random.Random(seed)
+    writer = Writer(f"bench-{seed}")
+    ops, op_weights = list(mix), list(itertools.accumulate(mix.values()))
+    list_weights = list(itertools.accumulate(1 / (k ** skew) for k in range(1, lists + 1)))
+    for _ in range(count):
+        op = rng.choices(ops, cum_weights=op_weights)[0]
+        list_id = f"bench-{rng.choices(range(lists), cum_weights=list_weights)[0]}"
+        if op in ITEM_OPS:
+            yield writer.request(op, list_id, f"i{rng.randrange(items)}", rng.randrange(10), 10)
+            continue
+        if op == "changes_since":
+            payload, list_id = {"versions": {}, "limit": 1}, None
+        else:
+            payload = {}
+        yield {"op": op, "list_id": list_id, "payload": payload}
+
+
+def seed_data(context, addr, list_ids, items):
+    """Create the lists a workload refers to, each with items i0..i<items-1>."""
+    ops = [as_merge(list_id, {f"i{j}": seed_state(list_id, f"i{j}") for j in range(items)}) for list_id in list_ids]
+    for start in range(0, len(ops), 500):
+        reply = call(context, addr, {"op": "batch", "ops": ops[start:start + 500]}, timeout=30)
+        if reply.get("status") != "ok":
+            raise Exception(f"Seeding failed: {reply}")
+
+
+def run_client(addrs, requests, window, timeout, results):
+    """Keep up to window requests in flight; report per-op latencies and statuses."""
+    context = zmq.Context()
+    sock = context.socket(zmq.DEALER)
+    for addr in addrs:
+        sock.connect(addr)
+    sent_at = {}
+    latencies, statuses = {}, {}
+    pending = iter(requests)
+    exhausted = False
+    start = time.perf_counter()
+    while True:
+        while not exhausted and len(sent_at) < window:
+            req = next(pending, None)
+            if req is None:
+                exhausted = True
+                break
+            req_id = uuid.uuid4().hex
+            sent_at[req_id] = (req["op"], time.perf_counter())
+            sock.send_multipart(request_frames(dict(req, req_id=req_id)))
+        if not sent_at:
+            break
+        if not sock.poll(timeout * 1000):
+            statuses["lost"] = statuses.get("lost", 0) + len(sent_at)
+            break
+        reply = decode(sock.recv())
+        op, t = sent_at.pop(reply.get("req_id"), (None, None))
+        if op is None:
+            continue
+        latencies.setdefault(op, []).append(time.perf_counter() - t)
+        key = f"{op}:{reply.get('status')}"
+        statuses[key] = statuses.get(key, 0) + 1
+    results.put({"latencies": latencies, "statuses": statuses, "elapsed": time.perf_counter() - start})
+    sock.close(linger=0)
+    context.term()
+
+
+def run_probe(addr, stop, results):
+    """Ping the proxy throughout the run: the client <-> proxy hop under load."""
+    context = zmq.Context()
+    sock = context.socket(zmq.DEALER)
+    sock.connect(addr)
+    samples = []
+    while not stop.is_set():
+        t = time.perf_counter()
+        sock.send_multipart(request_frames({"op": "ping", "req_id": "probe"}))
+        if sock.poll(2000):
+            sock.recv()
+            samples.append(time.perf_counter() - t)
+        time.sleep(PROBE_INTERVAL)
+    results.put(samples)
+    sock.close(linger=0)
+    context.term()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(samples):
+    values = sorted(samples)
+    return {"count": len(values), "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3), "max_ms": round((values[-1] if values else 0) * 1000, 3)}
+
+
+def run(cluster, requests, clients, window, timeout=5.0):
+    """Replay requests from clients concurrent processes and return the report."""
+    addrs = cluster.live_frontends()
+    spawn = multiprocessing.get_context("spawn")
+    results = spawn.Queue()
+    stop = spawn.Event()
+    probe = spawn.Process(target=run_probe, args=(addrs[0], stop, results))
+    shares = [requests[i::clients] for i in range(clients)]
+    workers = [spawn.Process(target=run_client, args=(addrs, share, window, timeout, results)) for share in shares]
+    probe.start()
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    reports = [results.get() for _ in workers]
+    elapsed = time.perf_counter() - start
+    stop.set()
+    pings = results.get()
+    for p in workers + [probe]:
+        p.join()
+
+    latencies, statuses = {}, {}
+    for r in reports:
+        for op, values in r["latencies"].items():
+            latencies.setdefault(op, []).extend(values)
+        for key, n in r["statuses"].items():
+            statuses[key] = statuses.get(key, 0) + n
+    done = sum(len(v) for v in latencies.values())
+    return {"requests": len(requests), "completed": done, "seconds": round(elapsed, 3),
+            "throughput": round(done / elapsed, 1),
+            "all": summarize([x for v in latencies.values() for x in v]),
+            "ops": {op: summarize(v) for op, v in sorted(latencies.items())},
+            "statuses": statuses,
+            "hops": {"client-proxy": summarize(pings),
+                     "proxy-server": {name: {k: s[k] for k in ("latency_ms", "in_flight", "sent", "busy", "timeouts")}
+                                      for st in cluster.stats() for name, s in st["servers"].items()}}}
+
+
+def print_report(report):
+    print(f"\n{report['completed']}/{report['requests']} requests in {report['seconds']}s: "
+          f"{report['throughput']} req/s")
+    print(f"{'op':<16}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for op, s in list(report["ops"].items()) + [("all", report["all"])]:
+        print(f"{op:<16}{s['count']:>8}{s['p50_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+    print(f"Statuses: {report['statuses']}")
+    hop = report["hops"]["client-proxy"]
+    print(f"Hop client-proxy (ping): p50 {hop['p50_ms']} ms, p99 {hop['p99_ms']} ms over {hop['count']} probes")
+    for name, s in report["hops"]["proxy-server"].items():
+        print(f"Hop proxy-{name}: {s['latency_ms']} ms (moving average), sent {s['sent']}, "
+              f"busy {s['busy']}, timeouts {s['timeouts']}")
+
+
+def compare(report, baseline, tolerance):
+    """Regressions beyond tolerance (a fraction) against an earlier report."""
+    problems = []
+    if report["throughput"] < baseline["throughput"] * (1 - tolerance):
+        problems.append(f"throughput {report['throughput']} < baseline {baseline['throughput']}")
+    for op, s in report["ops"].items():
+        old = baseline["ops"].get(op)
+        if old and s["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            problems.append(f"{op} p99 {s['p99_ms']} ms > baseline {old['p99_ms']} ms")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a local cluster end to end.")
+    parser.add_argument("--proxies", type=int, default=1)
+    parser.add_argument("--servers", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes per proxy")
+    parser.add_argument("--durability", default="normal")
+    parser.add_argument("--base-port", type=int, default=BASE_PORT)
+    parser.add_argument("--clients", type=int, default=4, help="concurrent client processes")
+    parser.add_argument("--window", type=int, default=16, help="requests in flight per client")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--mix", default="get_info=0.8,update_item=0.2", help="op=weight,...")
+    parser.add_argument("--lists", type=int, default=100)
+    parser.add_argument("--items", type=int, default=20, help="items per list")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent for list popularity; 0 is uniform")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--replay", help="JSONL file of requests to send instead of a synthetic workload")
+    parser.add_argument("--record", help="write the synthetic workload to this JSONL file")
+    parser.add_argument("--out", help="write the report as JSON")
+    parser.add_argument("--baseline", help="earlier --out report; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--keep", action="store_true", help="keep logs and stores")
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay) as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+    else:
+        requests = list(synthetic(args.requests, parse_mix(args.mix), args.lists, args.items, args.skew, args.seed))
+        if args.record:
+            with open(args.record, "w") as f:
+                f.writelines(json.dumps(r) + "\n" for r in requests)
+
+    cluster = Cluster(args.proxies, args.servers, args.workers, args.base_port, args.durability)
+    try:
+        print(f"Starting {args.proxies} proxies ({args.workers} workers each) and {args.servers} servers...")
+        cluster.start()
+        list_ids = sorted({r["list_id"] for r in requests if r.get("list_id") is not None})
+        print(f"Seeding {len(list_ids)} lists of {args.items} items...")
+        seed_data(cluster.context, cluster.live_frontends()[0], list_ids, args.items)
+        print(f"Running {len(requests)} requests from {args.clients} clients, {args.window} in flight each...")
+        report = run(cluster, requests, args.clients, args.window)
+    finally:
+        cluster.stop(args.keep)
+
+    print_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(report, json.load(f), args.tolerance)
+        for p in problems:
+            print(f"REGRESSION: {p}")
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,58 @@
 import zmq
 import uuid
+from zmq.utils.monitor import parse_monitor_message
 import sqlite3
 import json
 import time
+import random
+import functools
+import crdt
+import schema
+from metrics import REGISTRY as metrics
+from protocol import request_frames, decode, FORMATS, JSON
 
 DB_FILE = "client.db"
+BATCH_SIZE = 500
+PAGE_SIZE = 500
+# Fraction of requests sent with a trace, stamped by every hop (see metrics.py).
+TRACE_SAMPLE = 0.0
+
+# Clients keep a connection to every proxy and spread requests over the ones
+# that are up. ZeroMQ heartbeats each connection; a proxy that stops answering
+# them, or whose connection drops, is taken out of rotation at once and the
+# requests waiting on it are sent again through another proxy. It rejoins
+# when its connection is re-established.
+PROXIES = ["tcp://localhost:5558", "tcp://localhost:5560"]
+PROXY_HEARTBEAT_IVL = 100      # ms
+PROXY_HEARTBEAT_TIMEOUT = 300  # ms
+PROXY_EVENTS = zmq.EVENT_HANDSHAKE_SUCCEEDED | zmq.EVENT_DISCONNECTED
+
+# get_info keeps the servers' last answer for each list in client.db, with the
+# list's version and the lease the servers granted on it. How reads use it:
+#   "strong"   - always ask; with a copy the request is conditional, so an
+#                unchanged list comes back "not_modified", without its items.
+#   "lease"    - answer from the copy while the lease lasts, revalidating in
+#                the background once half of it has passed.
+#   "eventual" - answer from any copy, revalidating in the background once
+#                its lease has run out.
+# A write the servers acknowledge, or a sync bringing changes to a list,
+# voids its copy, so the next read asks again and sees them.
+CONSISTENCY = "lease"
+CONSISTENCY_MODES = ("strong", "lease", "eventual")
+REVALIDATE_TIMEOUT = 2.0  # seconds before a background revalidation is given up
 
 def init_db():
     conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    schema.migrate(conn, MIGRATIONS)
+    return conn
+
 
+def _schema_v1(c):
+    """Baseline tables, sync watermarks and CRDT state.
+
+    Stores created before versioning already have some of these; every
+    statement here tolerates that.
+    """
     c.execute('''CREATE TABLE IF NOT EXISTS shopping_lists (
                     id TEXT PRIMARY KEY,
                     synced INTEGER DEFAULT 0
@@ -25,216 +68,664 @@ def init_db():
                     synced INTEGER DEFAULT 0,
                     FOREIGN KEY(list_id) REFERENCES shopping_lists(id)
                 )''')
-    conn.commit()
-    return conn
+
+    # Last change-log version seen from each server node
+    c.execute('''CREATE TABLE IF NOT EXISTS sync_state (
+                    node TEXT PRIMARY KEY,
+                    version INTEGER
+                )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)''')
+    c.execute("INSERT OR IGNORE INTO meta(key, value) VALUES ('replica_id', ?)", (str(uuid.uuid4()),))
+
+    # CRDT state per item (see crdt.py). rev counts local changes so a late
+    # ack cannot mark a newer local change as synced.
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='item_state'")
+    new_state = c.fetchone() is None
+    c.execute('''CREATE TABLE IF NOT EXISTS item_state (
+                    list_id TEXT,
+                    name TEXT,
+                    state TEXT,
+                    synced INTEGER DEFAULT 1,
+                    rev INTEGER DEFAULT 0,
+                    PRIMARY KEY(list_id, name)
+                )''')
+    if new_state:
+        # Synced rows have no CRDT history here; drop them and re-fetch from the servers.
+        c.execute("DELETE FROM items WHERE synced=1")
+        c.execute("DELETE FROM sync_state")
+        replica = c.execute("SELECT value FROM meta WHERE key='replica_id'").fetchone()[0]
+        c.execute("SELECT list_id, name, current_qtd, target_qtd FROM items")
+        for list_id, name, current, target in c.fetchall():
+            delta = crdt.add_delta(crdt.new_item(), replica, crdt.next_dot(c, replica), current, target)
+            crdt.merge_into(c, list_id, name, delta)
+            c.execute("UPDATE item_state SET synced=0, rev=1 WHERE list_id=? AND name=?", (list_id, name))
+
+
+def _schema_v2(c):
+    """One row per item, and indexes for the unsynced scans of commit_all.
+
+    Older stores may hold duplicates from repeated create_item calls; the
+    newest row of each is the one reads used to see last.
+    """
+    c.execute("DELETE FROM items WHERE id NOT IN (SELECT MAX(id) FROM items GROUP BY list_id, name)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS items_key ON items(list_id, name)")
+    # Partial indexes hold only the unsynced rows, so they stay small however large the store grows.
+    c.execute("CREATE INDEX IF NOT EXISTS shopping_lists_unsynced ON shopping_lists(id) WHERE synced=0")
+    c.execute("CREATE INDEX IF NOT EXISTS item_state_unsynced ON item_state(list_id, name, rev) WHERE synced=0")
+
+
+def _schema_v3(c):
+    """Outbound operation log, drained by commit_all instead of scanning synced flags.
+
+    Pending work of older stores is carried over: unsynced lists, and
+    unsynced items as their full state.
+    """
+    # Append-only: one entry per local change; delta is the CRDT delta as
+    # JSON, NULL for a list creation (name '').
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    list_id TEXT,
+                    name TEXT,
+                    delta TEXT
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS outbox_key ON outbox(list_id, name)")
+    c.execute("INSERT INTO outbox(list_id, name) SELECT id, '' FROM shopping_lists WHERE synced=0")
+    c.execute("INSERT INTO outbox(list_id, name, delta) SELECT list_id, name, state FROM item_state WHERE synced=0")
+    c.execute("DROP INDEX IF EXISTS shopping_lists_unsynced")
+    c.execute("DROP INDEX IF EXISTS item_state_unsynced")
+
+
+def _schema_v4(c):
+    """Servers' last get_info answer per list, for reads that may be served locally."""
+    # expires is NULL once the copy is void.
+    c.execute('''CREATE TABLE IF NOT EXISTS server_lists (
+                    list_id TEXT PRIMARY KEY,
+                    version TEXT,
+                    reply TEXT,
+                    checked REAL,
+                    expires REAL
+                )''')
+
+
+MIGRATIONS = [_schema_v1, _schema_v2, _schema_v3, _schema_v4]
+
+
+def proxy_socket(ctx, addr):
+    """A heartbeated DEALER to one proxy, and a monitor reporting when it goes up or down."""
+    sock = ctx.socket(zmq.DEALER)
+    sock.setsockopt_string(zmq.IDENTITY, f"client-{uuid.uuid4()}")
+    sock.setsockopt(zmq.HEARTBEAT_IVL, PROXY_HEARTBEAT_IVL)
+    sock.setsockopt(zmq.HEARTBEAT_TIMEOUT, PROXY_HEARTBEAT_TIMEOUT)
+    monitor = sock.get_monitor_socket(PROXY_EVENTS)
+    sock.connect(addr)
+    return sock, monitor
+
+
+class ProxySet:
+    """Which proxies are up, and whose turn it is."""
+
+    def __init__(self, addrs):
+        self.addrs = list(addrs)
+        self.up = set()
+        self.lost = set()
+        self.formats = {}  # proxy index -> body format negotiated with it
+        self.turn = 0
+
+    def event(self, i, frames):
+        """Apply a monitor event. Returns True if the proxy just went down."""
+        event = parse_monitor_message(frames)["event"]
+        if event == zmq.EVENT_HANDSHAKE_SUCCEEDED:
+            if i in self.lost:
+                self.lost.discard(i)
+                print(f"Proxy {self.addrs[i]} is back.")
+            self.up.add(i)
+        elif event == zmq.EVENT_DISCONNECTED and i in self.up:
+            self.up.discard(i)
+            self.lost.add(i)
+            metrics.inc("client.proxy_failovers")
+            print(f"Proxy {self.addrs[i]} is down; using the others.")
+            return True
+        return False
+
+    def pick(self):
+        """The next proxy that is up, round robin; None if none is."""
+        for _ in range(len(self.addrs)):
+            i = self.turn % len(self.addrs)
+            self.turn += 1
+            if i in self.up:
+                return i
+        return None
+
+    def format(self, i):
+        return self.formats.get(i, JSON)
+
+
+def batch_results(resp, count):
+    """Unpack a batch reply into one result per op; a failed batch fails every op."""
+    if resp.get("status") == "ok":
+        return resp["results"]
+    return [resp] * count
 
 
 class Client:
-    def __init__(self, proxy_addrs=["tcp://localhost:5558", "tcp://localhost:5560"]):
-        self.conn = init_db()
-        self.connected = False
+    def __init__(self, proxy_addrs=PROXIES, consistency=CONSISTENCY):
+        self._init_state(proxy_addrs, consistency)
         self.ctx = zmq.Context()
-
+        self.socks, self.monitors = [], []
+        self.poller = zmq.Poller()
         for addr in proxy_addrs:
-            try:
-                sock = self.ctx.socket(zmq.DEALER)
-                sock.setsockopt_string(zmq.IDENTITY, f"client-{uuid.uuid4()}")
-                poller = zmq.Poller()
-                poller.register(sock, zmq.POLLIN)
-                sock.connect(addr)
-
-                print(f"Connecting to proxy: {addr}...")
-                if self._test_connection(sock, poller):
-                    print(f"Connected to proxy: {addr}")
-                    self.sock = sock
-                    self.poller = poller
-                    self.connected = True
-                    break
-                else:
-                    print(f"Failed to connect to proxy: {addr}")
-                    sock.close()
-            except Exception as e:
-                print(f"Error trying to connect to proxy {addr}: {e}")
-                continue
-
-        if not self.connected:
+            print(f"Connecting to proxy: {addr}...")
+            sock, monitor = proxy_socket(self.ctx, addr)
+            self.socks.append(sock)
+            self.monitors.append(monitor)
+            self.poller.register(sock, zmq.POLLIN)
+            self.poller.register(monitor, zmq.POLLIN)
+
+        if not self._test_connection():
             raise Exception("Could not connect to any proxy.")
+        self.connected = True
 
-    def _test_connection(self, sock, poller, retries=3):
+    def _init_state(self, proxy_addrs, consistency):
+        """The local store and the bookkeeping shared with AsyncClient."""
+        self.conn = init_db()
+        self.connected = False
+        self.trace_sample = TRACE_SAMPLE
+        self.consistency = consistency
+        self.generations = {}   # list_id -> count of voids, to spot answers they overtook
+        # Background revalidations in flight. Client: req_id -> (list_id, copy,
+        # generation, message, sent); AsyncClient: list_id -> task.
+        self.revalidating = {}
+        self.proxies = ProxySet(proxy_addrs)
+
+    def _test_connection(self, retries=3):
+        """Ping every proxy; the ones that answer are up. Each pong settles that proxy's format."""
         for _ in range(retries):
-            try:
-                sock.send_json({"op": "ping"})
-                socks = dict(poller.poll(2000))
-                if socks.get(sock) == zmq.POLLIN:
-                    response = sock.recv_json()
-                    if response.get("status") == "pong":
-                        return True
-            except Exception:
-                pass
+            waiting = {}
+            for i, sock in enumerate(self.socks):
+                req_id = uuid.uuid4().hex
+                waiting[req_id] = i
+                sock.send_multipart(request_frames({"op": "ping", "req_id": req_id, "formats": FORMATS}))
+            deadline = time.time() + 2
+            while waiting and time.time() < deadline:
+                for sock, _ in self.poller.poll((deadline - time.time()) * 1000):
+                    if sock in self.monitors:
+                        sock.recv_multipart()  # the pong decides, not the handshake
+                        continue
+                    resp = decode(sock.recv())
+                    i = waiting.pop(resp.get("req_id"), None)
+                    if i is not None and resp.get("status") == "pong":
+                        self.proxies.up.add(i)
+                        self.proxies.formats[i] = resp.get("format", JSON)
+                        print(f"Connected to proxy: {self.proxies.addrs[i]}")
+            for i in waiting.values():
+                print(f"Failed to connect to proxy: {self.proxies.addrs[i]}")
+            if self.proxies.up:
+                return True
             time.sleep(0.1)
         return False
 
-    def send_request(self, op, list_id, payload=None):
+    def _call(self, msg, timeout):
+        """Send msg through the next proxy and wait for its reply. If that proxy goes
+        down meanwhile, the same request (same req_id) is sent through another one."""
+        deadline = time.time() + timeout / 1000
+        via = self.proxies.pick()
+        if via is not None:
+            self.socks[via].send_multipart(request_frames(msg, self.proxies.format(via)))
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return {"status": "timeout"}
+            for sock, _ in self.poller.poll(remaining * 1000):
+                if sock in self.monitors:
+                    i = self.monitors.index(sock)
+                    self.proxies.event(i, sock.recv_multipart())
+                    continue
+                response = decode(sock.recv())
+                if response.get("req_id") == msg["req_id"]:
+                    return response
+                self._background(response)
+            if via is None or via not in self.proxies.up:
+                via = self.proxies.pick()
+                if via is not None:
+                    metrics.inc("client.resends")
+                    self.socks[via].send_multipart(request_frames(msg, self.proxies.format(via)))
+
+    def _background(self, resp):
+        """Handle a reply nobody is waiting for: a background revalidation, or
+        a late reply to a request that timed out, which is dropped."""
+        waiting = self.revalidating.pop(resp.get("req_id"), None)
+        if waiting is None:
+            return
+        list_id, copy, generation, msg, sent = waiting
+        self._store_revalidated(list_id, copy, self._record(msg, resp, sent), generation)
+
+    def _drain(self):
+        """Handle whatever arrived while no request was waiting."""
+        now = time.perf_counter()
+        for req_id, waiting in list(self.revalidating.items()):
+            if now - waiting[4] > REVALIDATE_TIMEOUT:
+                del self.revalidating[req_id]
+        while True:
+            ready = self.poller.poll(0)
+            if not ready:
+                return
+            for sock, _ in ready:
+                if sock in self.monitors:
+                    self.proxies.event(self.monitors.index(sock), sock.recv_multipart())
+                else:
+                    self._background(decode(sock.recv()))
+
+    def _traced(self, msg):
+        if self.trace_sample and random.random() < self.trace_sample:
+            msg["trace"] = [["client.send", time.time()]]
+        return msg
+
+    def _record(self, msg, resp, started):
+        metrics.observe(f"client.latency.{msg['op']}", time.perf_counter() - started)
+        metrics.inc(f"client.replies.{resp.get('status')}")
+        if "trace" in resp:
+            metrics.trace(msg["req_id"], resp["trace"] + [["client.recv", time.time()]])
+        return resp
+
+    def send_request(self, op, list_id, payload=None, timeout=2000):
         if payload is None:
             payload = {}
-        self.sock.send_json({"op": op, "list_id": list_id, "payload": payload})
-        socks = dict(self.poller.poll(2000))
-        if socks.get(self.sock) == zmq.POLLIN:
-            return self.sock.recv_json()
-        return {"status": "timeout"}
+        msg = self._traced({"op": op, "list_id": list_id, "payload": payload, "req_id": uuid.uuid4().hex})
+        started = time.perf_counter()
+        return self._record(msg, self._call(msg, timeout), started)
+
+    def send_batch(self, ops, timeout=5000):
+        """Send many ops in as few round trips as possible. Returns one result per op, in order."""
+        results = []
+        for start in range(0, len(ops), BATCH_SIZE):
+            chunk = ops[start:start + BATCH_SIZE]
+            msg = {"op": "batch", "ops": chunk, "req_id": uuid.uuid4().hex}
+            started = time.perf_counter()
+            resp = self._record(msg, self._call(msg, timeout), started)
+            results.extend(batch_results(resp, len(chunk)))
+        return results
 
     def save_list_local(self, list_id):
         c = self.conn.cursor()
         try:
             c.execute("INSERT INTO shopping_lists(id, synced) VALUES (?, 0)", (list_id,))
+            self._append(c, list_id, "", None)
             self.conn.commit()
         except sqlite3.IntegrityError:
             pass
 
+    def _append(self, c, list_id, name, delta):
+        """Log a local change for the servers. Returns its sequence number."""
+        c.execute("INSERT INTO outbox(list_id, name, delta) VALUES (?, ?, ?)",
+                  (list_id, name, None if delta is None else json.dumps(delta, separators=(",", ":"))))
+        return c.lastrowid
+
+    def _pending(self, c, list_id, name):
+        """All unacked changes to an item joined into one delta."""
+        c.execute("SELECT delta FROM outbox WHERE list_id=? AND name=? ORDER BY seq", (list_id, name))
+        return functools.reduce(crdt.merge, (json.loads(d) for d, in c.fetchall()), crdt.new_item())
+
+    def _change_item_local(self, list_id, item_name, make_delta, existing=False):
+        """Apply a local change to an item and log it. Returns (what to send, seq).
+
+        What is sent covers every unacked change to the item, so it can be
+        acked up to seq even if earlier sends were lost. A change that needs an
+        existing item returns (None, None) for an unknown one, and logs nothing.
+        """
+        c = self.conn.cursor()
+        item = crdt.load_item(c, list_id, item_name)
+        if existing and not crdt.is_present(item):
+            return None, None
+        delta = make_delta(item)
+        state, _ = crdt.merge_into(c, list_id, item_name, delta)
+        c.execute("UPDATE item_state SET synced=0 WHERE list_id=? AND name=?", (list_id, item_name))
+        c.execute("SELECT COUNT(*) FROM outbox WHERE list_id=? AND name=?", (list_id, item_name))
+        earlier = c.fetchone()[0]
+        seq = self._append(c, list_id, item_name, delta)
+        self._materialize(c, list_id, item_name, state, 0)
+        self.conn.commit()
+        return (self._pending(c, list_id, item_name) if earlier else delta), seq
+
+    def _materialize(self, c, list_id, item_name, state, synced):
+        if crdt.is_present(state):
+            current, total = crdt.values(state)
+            c.execute("""INSERT INTO items(list_id, name, current_qtd, target_qtd, acquired_flag, synced)
+                         VALUES (?, ?, ?, ?, 0, ?)
+                         ON CONFLICT(list_id, name) DO UPDATE
+                         SET current_qtd=excluded.current_qtd, target_qtd=excluded.target_qtd, synced=excluded.synced""",
+                      (list_id, item_name, current, total, synced))
+        else:
+            c.execute("DELETE FROM items WHERE list_id=? AND name=?", (list_id, item_name))
+
+    def _replica(self):
+        return self.conn.execute("SELECT value FROM meta WHERE key='replica_id'").fetchone()[0]
+
     def save_item_local(self, list_id, item_name, current, total):
+        replica = self._replica()
+        return self._change_item_local(list_id, item_name, lambda item: crdt.add_delta(
+            item, replica, crdt.next_dot(self.conn.cursor(), replica), current, total))
+
+    def update_item_local(self, list_id, item_name, current, total):
+        replica = self._replica()
+        return self._change_item_local(list_id, item_name,
+                                       lambda item: crdt.set_delta(item, replica, current, total), existing=True)
+
+    def delete_item_local(self, list_id, item_name):
+        return self._change_item_local(list_id, item_name, crdt.remove_delta, existing=True)
+
+    def _mark_item_synced(self, c, list_id, item_name, seq):
+        """The servers have the item's changes up to seq; it is synced once none are left."""
+        c.execute("DELETE FROM outbox WHERE list_id=? AND name=? AND seq<=?", (list_id, item_name, seq))
+        c.execute("SELECT 1 FROM outbox WHERE list_id=? AND name=? LIMIT 1", (list_id, item_name))
+        if c.fetchone() is None:
+            c.execute("UPDATE item_state SET synced=1 WHERE list_id=? AND name=?", (list_id, item_name))
+            c.execute("UPDATE items SET synced=1 WHERE list_id=? AND name=?", (list_id, item_name))
+        self._void_copy(c, list_id)
+
+    def _mark_list_synced(self, c, list_id):
+        c.execute("DELETE FROM outbox WHERE list_id=? AND name=''", (list_id,))
+        c.execute("UPDATE shopping_lists SET synced=1 WHERE id=?", (list_id,))
+        self._void_copy(c, list_id)
+
+    def _void_copy(self, c, list_id):
+        """The servers' copy of the list is out of date; answers already on their way are too."""
+        c.execute("UPDATE server_lists SET expires=NULL WHERE list_id=?", (list_id,))
+        self.generations[list_id] = self.generations.get(list_id, 0) + 1
+
+    def _server_copy(self, list_id):
+        c = self.conn.cursor()
+        c.execute("SELECT version, reply, checked, expires FROM server_lists WHERE list_id=?", (list_id,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        return {"version": row[0], "reply": json.loads(row[1]), "checked": row[2], "expires": row[3]}
+
+    def _plan_read(self, copy, consistency):
+        """(answer from the copy, revalidate it in the background) for a read in this mode."""
+        if consistency not in CONSISTENCY_MODES:
+            raise ValueError(f"Unknown consistency mode: {consistency}")
+        if copy is None or copy["expires"] is None or consistency == "strong":
+            return False, False
+        now = time.time()
+        if consistency == "lease":
+            if now >= copy["expires"]:
+                return False, False
+            return True, now >= (copy["checked"] + copy["expires"]) / 2
+        return True, now >= copy["expires"]
+
+    def _conditional(self, copy):
+        return {"if_version": copy["version"]} if copy else {}
+
+    def _from_copy(self, copy):
+        metrics.inc("client.reads.local")
+        return dict(copy["reply"], cached=True)
+
+    def _store_copy(self, list_id, copy, resp, generation):
+        """Bring the list's copy up to date with a get_info answer. Returns the answer,
+        with the copy's contents when it was "not_modified"."""
+        status = resp.get("status")
+        # An answer that a void overtook may predate the write that caused it: show it, keep nothing.
+        current = self.generations.get(list_id, 0) == generation
         c = self.conn.cursor()
-        c.execute("""INSERT INTO items(list_id, name, current_qtd, target_qtd, acquired_flag, synced)
-                     VALUES (?, ?, ?, ?, 0, 0)""",
-                  (list_id, item_name, current, total))
+        now = time.time()
+        if status == "not_modified":
+            if current:
+                c.execute("UPDATE server_lists SET checked=?, expires=? WHERE list_id=? AND version=?",
+                          (now, now + resp["lease"], list_id, resp["version"]))
+            resp = dict(copy["reply"], status="ok")
+        elif status == "ok" and "version" in resp and current:
+            reply = {"status": "ok", "list": resp["list"], "version": resp["version"]}
+            c.execute("INSERT OR REPLACE INTO server_lists(list_id, version, reply, checked, expires) VALUES (?, ?, ?, ?, ?)",
+                      (list_id, resp["version"], json.dumps(reply), now, now + resp.get("lease", 0)))
+        elif resp.get("message") == "List not found":
+            c.execute("DELETE FROM server_lists WHERE list_id=?", (list_id,))
         self.conn.commit()
+        return resp
 
-    def create_list(self, list_id):
-        self.save_list_local(list_id)
-        resp = self.send_request("create_list", list_id)
-        if resp.get("status") == "ok":
-            c = self.conn.cursor()
-            c.execute("UPDATE shopping_lists SET synced=1 WHERE id=?", (list_id,))
+    def _store_revalidated(self, list_id, copy, resp, generation):
+        """Handle the answer to a background revalidation. It is a single page, so a list
+        that changed and needs more is left for the next read to fetch in full."""
+        if resp.get("next"):
+            self._void_copy(self.conn.cursor(), list_id)
             self.conn.commit()
-            print(f"List '{list_id}' synced with server.")
-        elif resp.get("status") == "timeout":
-            print("Server not reachable. Saved locally (unsynced).")
-        return resp
+        else:
+            self._store_copy(list_id, copy, resp, generation)
 
-    def create_item(self, list_id, item_name, current, total):
-        self.save_item_local(list_id, item_name, current, total)
-        resp = self.send_request("create_item", list_id,
-                                 {"item_name": item_name, "current": current, "total": total})
+    def _revalidate(self, list_id, copy):
+        """Send a conditional get_info without waiting; its answer is handled when it arrives."""
+        if any(waiting[0] == list_id for waiting in self.revalidating.values()):
+            return
+        via = self.proxies.pick()
+        if via is None:
+            return
+        msg = self._traced({"op": "get_info", "list_id": list_id, "payload": self._conditional(copy),
+                            "req_id": uuid.uuid4().hex})
+        self.revalidating[msg["req_id"]] = (list_id, copy, self.generations.get(list_id, 0), msg, time.perf_counter())
+        self.socks[via].send_multipart(request_frames(msg, self.proxies.format(via)))
+
+    # Outcomes are counted by _record (client.replies.*); only the REPL prints them.
+    def _list_result(self, list_id, resp):
         if resp.get("status") == "ok":
-            c = self.conn.cursor()
-            c.execute("UPDATE items SET synced=1 WHERE list_id=? AND name=?", (list_id, item_name))
+            self._mark_list_synced(self.conn.cursor(), list_id)
             self.conn.commit()
-            print(f"Item '{item_name}' synced with server.")
-        elif resp.get("status") == "timeout":
-            print("Server not reachable. Saved locally (unsynced).")
         return resp
 
-    def update_item(self, list_id, item_name, current, total):
-        c = self.conn.cursor()
-        c.execute("""UPDATE items
-                     SET current_qtd=?, target_qtd=?, synced=0
-                     WHERE list_id=? AND name=?""",
-                  (current, total, list_id, item_name))
-        self.conn.commit()
-        resp = self.send_request("update_item", list_id,
-                                 {"item_name": item_name, "current": current, "total": total})
+    def _item_result(self, list_id, item_name, seq, resp):
+        if seq is None:
+            return {"status": "error", "message": "Item not found"}
         if resp.get("status") == "ok":
-            c.execute("UPDATE items SET synced=1 WHERE list_id=? AND name=?", (list_id, item_name))
+            self._mark_item_synced(self.conn.cursor(), list_id, item_name, seq)
             self.conn.commit()
-            print(f"Item '{item_name}' updated on server.")
-        elif resp.get("status") == "timeout":
-            print("Server not reachable. Change saved locally (unsynced).")
         return resp
 
+    def send_delta(self, list_id, item_name, delta):
+        return self.send_request("merge", list_id, {"items": {item_name: delta}})
+
+    def create_list(self, list_id):
+        self.save_list_local(list_id)
+        return self._list_result(list_id, self.send_request("create_list", list_id))
+
+    def create_item(self, list_id, item_name, current, total):
+        delta, seq = self.save_item_local(list_id, item_name, current, total)
+        resp = self.send_delta(list_id, item_name, delta)
+        return self._item_result(list_id, item_name, seq, resp)
+
+    def update_item(self, list_id, item_name, current, total):
+        delta, seq = self.update_item_local(list_id, item_name, current, total)
+        resp = self.send_delta(list_id, item_name, delta) if seq is not None else None
+        return self._item_result(list_id, item_name, seq, resp)
+
     def delete_item(self, list_id, item_name):
-        c = self.conn.cursor()
-        c.execute("DELETE FROM items WHERE list_id=? AND name=?", (list_id, item_name))
-        self.conn.commit()
-        resp = self.send_request("delete_item", list_id, {"item_name": item_name})
-        if resp.get("status") == "ok":
-            print(f"Item '{item_name}' deleted on server.")
-        elif resp.get("status") == "timeout":
-            print("Server not reachable. Deleted locally only.")
-        return resp
+        delta, seq = self.delete_item_local(list_id, item_name)
+        resp = self.send_delta(list_id, item_name, delta) if seq is not None else None
+        return self._item_result(list_id, item_name, seq, resp)
 
-    def get_info(self, list_id):
+    def get_info_local(self, list_id):
         c = self.conn.cursor()
         c.execute("SELECT id FROM shopping_lists WHERE id=?", (list_id,))
         list_row = c.fetchone()
         c.execute("SELECT name, current_qtd, target_qtd, acquired_flag FROM items WHERE list_id=?", (list_id,))
         items = [{"name": r[0], "current_qtd": r[1], "target_qtd": r[2], "acquired_flag": bool(r[3])} for r in c.fetchall()]
-        local = {"id": list_row[0], "items": items} if list_row else None
-        server = self.send_request("get_info", list_id)
-        return {"local": local, "server": server}
-
-    def commit_all(self):
+        return {"id": list_row[0], "items": items} if list_row else None
+
+    def get_info(self, list_id, consistency=None):
+        """The list as stored here and as the servers have it; see CONSISTENCY for when
+        the servers' side comes from the local copy."""
+        self._drain()
+        local = self.get_info_local(list_id)
+        copy = self._server_copy(list_id)
+        cached, revalidate = self._plan_read(copy, consistency or self.consistency)
+        if cached:
+            if revalidate:
+                self._revalidate(list_id, copy)
+            return {"local": local, "server": self._from_copy(copy)}
+        generation = self.generations.get(list_id, 0)
+        server = self.send_request("get_info", list_id, self._conditional(copy))
+        while server.get("next"):
+            page = self.send_request("get_info", list_id, {"after": server.pop("next"), "limit": PAGE_SIZE})
+            server = self._add_page(server, page)
+        return {"local": local, "server": self._store_copy(list_id, copy, server, generation)}
+
+    def _compact_outbox(self, c):
+        """Fold each key's pending entries into its newest one (CRDT join), so a run
+        of edits to one item goes out as a single op."""
+        c.execute("SELECT list_id, name, MAX(seq) FROM outbox GROUP BY list_id, name HAVING COUNT(*) > 1")
+        for list_id, name, last in c.fetchall():
+            if name:
+                delta = json.dumps(self._pending(c, list_id, name), separators=(",", ":"))
+                c.execute("UPDATE outbox SET delta=? WHERE seq=?", (delta, last))
+            c.execute("DELETE FROM outbox WHERE list_id=? AND name=? AND seq<?", (list_id, name, last))
+
+    def _start_commit(self):
+        """Compact the outbox. Returns False if there is nothing to push."""
         c = self.conn.cursor()
+        self._compact_outbox(c)
+        self.conn.commit()
+        c.execute("SELECT 1 FROM outbox LIMIT 1")
+        return c.fetchone() is not None
 
-        # Commit unsynced lists
-        c.execute("SELECT id FROM shopping_lists WHERE synced=0")
-        unsynced_lists = [r[0] for r in c.fetchall()]
-
-        # Commit unsynced items (may belong to already synced lists)
-        c.execute("SELECT DISTINCT list_id FROM items WHERE synced=0")
-        lists_with_unsynced_items = [r[0] for r in c.fetchall()]
-
-        if not unsynced_lists and not lists_with_unsynced_items:
-            print("Nothing to commit - all data is synced.")
-            return
-
-        print("Starting commit...")
+    def _commit_ops(self, after, window=BATCH_SIZE):
+        """The next window of the outbox after seq `after` as ops, in log order, or None when drained.
 
-        for list_id in unsynced_lists:
-            print(f"-> Committing list '{list_id}'")
-            resp = self.send_request("create_list", list_id)
+        Every list in the window becomes one merge op carrying its items; a merge
+        also creates the list, so list creations need no op of their own.
+        Returns (ops, acks, last) where acks maps (list_id, name) to the last seq
+        included for it.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT seq, list_id, name, delta FROM outbox WHERE seq > ? ORDER BY seq LIMIT ?", (after, window))
+        rows = c.fetchall()
+        if not rows:
+            return None
+
+        ops, merges, acks = [], {}, {}
+        for seq, list_id, name, delta in rows:
+            items = merges.get(list_id)
+            if items is None:
+                items = merges[list_id] = {}
+                ops.append({"op": "merge", "list_id": list_id, "payload": {"items": items}})
+            acks[(list_id, name)] = seq
+            if delta is not None:
+                delta = json.loads(delta)
+                items[name] = crdt.merge(items[name], delta) if name in items else delta
+        return ops, acks, rows[-1][0]
+
+    def _apply_commit(self, ops, acks, results):
+        """Drop what the servers acked from the outbox. Returns False if they could not be reached."""
+        c = self.conn.cursor()
+        reachable = True
+        for op, resp in zip(ops, results):
+            list_id = op["list_id"]
+            names = list(op["payload"]["items"])
             if resp.get("status") == "ok":
-                c.execute("UPDATE shopping_lists SET synced=1 WHERE id=?", (list_id,))
-                print(f"-> List '{list_id}' synced.")
-            elif resp.get("status") == "timeout":
-                print(f"Server not reachable for '{list_id}'. Skipping.")
-                continue
-
-        for list_id in lists_with_unsynced_items:
-            print(f"-> Committing unsynced items in list '{list_id}'")
-            c.execute("SELECT name, current_qtd, target_qtd FROM items WHERE list_id=? AND synced=0", (list_id,))
-            items = c.fetchall()
-            for name, current, total in items:
-                resp = self.send_request("create_item", list_id,
-                                         {"item_name": name, "current": current, "total": total})
-                if resp.get("status") == "ok":
-                    c.execute("UPDATE items SET synced=1 WHERE list_id=? AND name=?", (list_id, name))
-                    print(f"-> Item '{name}' synced.")
-                else:
-                    print(f"-> Failed to sync '{name}': {resp}")
+                if (list_id, "") in acks:
+                    self._mark_list_synced(c, list_id)
+                    metrics.inc("client.lists_pushed")
+                for name in names:
+                    self._mark_item_synced(c, list_id, name, acks[(list_id, name)])
+                metrics.inc("client.items_pushed", len(names))
+            elif resp.get("status") in ("timeout", "busy"):
+                # Backing off: pushing the rest now would only meet the same queue.
+                reachable = False
+                metrics.inc("client.lists_skipped")
+            else:
+                metrics.inc("client.lists_failed")
 
         self.conn.commit()
-        print("Commit complete - unsynced changes pushed.")
+        return reachable
 
-    def sync(self):
-        print("Syncing from servers...")
+    def commit_all(self):
+        """Drain the outbox oldest first, one window per round trip. Returns False
+        if the servers could not be reached; the rest stays queued."""
+        if not self._start_commit():
+            return True
+        after = 0
+        while True:
+            window = self._commit_ops(after)
+            if window is None:
+                return True
+            ops, acks, after = window
+            if not self._apply_commit(ops, acks, self.send_batch(ops)):
+                return False
+
+    def _sync_versions(self):
         c = self.conn.cursor()
-
-        resp = self.send_request("list_all_lists", None)
+        c.execute("SELECT node, version FROM sync_state")
+        return dict(c.fetchall())
+
+    def _add_page(self, server, page):
+        """Fold the next get_info page into the reply so far; a failed page fails the whole read."""
+        if page.get("status") != "ok":
+            return page
+        server["list"]["items"].extend(page["list"]["items"])
+        if page.get("next"):
+            server["next"] = page["next"]
+        return server
+
+    def _changes_request(self):
+        return {"versions": self._sync_versions(), "limit": PAGE_SIZE}
+
+    def _apply_changes(self, resp):
+        """Apply one page of each server's changes since our watermark for it, then advance
+        the watermarks. Returns (some server has more pages, every server answered)."""
         if resp.get("status") != "ok":
-            print("Could not fetch list of lists from server.")
-            return
+            return False, False
 
-        server_lists = set(resp["lists"])
-        c.execute("SELECT id FROM shopping_lists")
-        local_lists = set(r[0] for r in c.fetchall())
-
-        for list_id in local_lists - server_lists:
-            print(f"Removing deleted list '{list_id}' locally.")
-            c.execute("DELETE FROM items WHERE list_id=?", (list_id,))
-            c.execute("DELETE FROM shopping_lists WHERE id=?", (list_id,))
-
-        for list_id in server_lists:
-            resp = self.send_request("get_info", list_id)
-            if resp.get("status") == "ok":
-                print(f"-> Syncing list '{list_id}'")
-                c.execute("DELETE FROM items WHERE list_id=?", (list_id,))
-                for item in resp["list"]["items"]:
-                    c.execute("""INSERT INTO items(list_id, name, current_qtd, target_qtd, acquired_flag, synced)
-                                 VALUES (?, ?, ?, ?, ?, 1)""",
-                              (list_id, item["name"], item["current_qtd"], item["target_qtd"], int(item["acquired_flag"])))
-                c.execute("INSERT OR REPLACE INTO shopping_lists(id, synced) VALUES (?, 1)", (list_id,))
+        c = self.conn.cursor()
+        more = False
+        answered = True
+        touched = set()
+        for node in resp["results"]:
+            if node.get("status") != "ok":
+                # Its watermark stays put, so the next sync asks again.
+                answered = False
+                continue
 
+            touched.update(node["lists"])
+            touched.update(item["list_id"] for item in node["items"])
+            for list_id in node["lists"]:
+                c.execute("""INSERT INTO shopping_lists(id, synced) VALUES (?, 1)
+                             ON CONFLICT(id) DO UPDATE SET synced=1""", (list_id,))
+            for item in node["items"]:
+                # Merge rather than overwrite, so unsynced local changes survive.
+                list_id, name = item["list_id"], item["name"]
+                c.execute("INSERT OR IGNORE INTO shopping_lists(id, synced) VALUES (?, 1)", (list_id,))
+                state, changed = crdt.merge_into(c, list_id, name, item["state"])
+                if changed:
+                    c.execute("SELECT synced FROM item_state WHERE list_id=? AND name=?", (list_id, name))
+                    self._materialize(c, list_id, name, state, c.fetchone()[0])
+
+            c.execute("INSERT OR REPLACE INTO sync_state(node, version) VALUES (?, ?)", (node["node"], node["version"]))
+            metrics.inc("client.changes_applied", len(node["lists"]) + len(node["items"]))
+            more = more or node.get("more", False)
+
+        for list_id in touched:
+            self._void_copy(c, list_id)
         self.conn.commit()
-        print("Sync complete.")
+        return more, answered
+
+    def sync(self):
+        """Pull changes a page at a time; each page is committed before the next is fetched.
+        Returns False if some server did not answer."""
+        complete = more = True
+        while more:
+            more, answered = self._apply_changes(self.send_request("changes_since", None, self._changes_request()))
+            complete = complete and answered
+        return complete
+
+
+def report(resp, done, offline):
+    """Print the outcome of a change for the REPL."""
+    status = resp.get("status")
+    if status == "ok":
+        print(done)
+    elif status == "timeout":
+        print(f"Server not reachable. {offline}")
+    elif status == "busy":
+        print(f"Server busy. {offline}")
+    else:
+        print(f"Server error: {resp.get('message')}")
 
 
 def main():
@@ -250,19 +741,29 @@ def main():
             if op == "exit":
                 break
             elif op == "create_list":
-                client.create_list(cmd[1])
+                report(client.create_list(cmd[1]), f"List '{cmd[1]}' synced with server.", "Saved locally (unsynced).")
             elif op == "create_item":
-                client.create_item(cmd[1], cmd[2], int(cmd[3]), int(cmd[4]))
+                report(client.create_item(cmd[1], cmd[2], int(cmd[3]), int(cmd[4])),
+                       f"Item '{cmd[2]}' synced with server.", "Saved locally (unsynced).")
             elif op == "update_item":
-                client.update_item(cmd[1], cmd[2], int(cmd[3]), int(cmd[4]))
+                report(client.update_item(cmd[1], cmd[2], int(cmd[3]), int(cmd[4])),
+                       f"Item '{cmd[2]}' updated on server.", "Change saved locally (unsynced).")
             elif op == "delete_item":
-                client.delete_item(cmd[1], cmd[2])
+                report(client.delete_item(cmd[1], cmd[2]), f"Item '{cmd[2]}' deleted on server.", "Deleted locally only.")
             elif op == "get_info":
-                print(json.dumps(client.get_info(cmd[1]), indent=2))
+                # get_info <list> [strong|lease|eventual]
+                print(json.dumps(client.get_info(cmd[1], *cmd[2:3]), indent=2))
             elif op == "commit":
-                client.commit_all()
+                if client.commit_all():
+                    print("Commit complete - all changes pushed.")
+                else:
+                    print("Commit stopped - the rest stays queued.")
             elif op == "sync":
-                client.sync()
+                print("Syncing from servers...")
+                if client.sync():
+                    print("Sync complete.")
+                else:
+                    print("Sync incomplete - a server did not answer; will retry on next sync.")
             else:
                 print("Invalid command.")
         except Exception as e:
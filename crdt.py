@@ -0,0 +1,118 @@
+import json
+import hashlib
+
+# Delta-state CRDT for shopping list items.
+#
+# An item is an observed-remove set entry plus two PN-counters:
+#   {"adds": [dot, ...], "removes": [dot, ...],
+#    "current": {"p": {replica: n}, "n": {replica: n}},
+#    "target":  {"p": {...}, "n": {...}}}
+# A dot is "<replica>:<counter>" and is unique per add. The item is present
+# while some add dot has not been removed, so a remove only cancels the adds
+# it has seen and a concurrent add wins. Counters only ever grow per replica.
+# merge() is commutative, associative and idempotent, and any state (or any
+# subset of its fields) is a valid delta, so replicas exchange just the
+# fields an operation touched.
+
+
+def new_item():
+    return {"adds": [], "removes": [], "current": {"p": {}, "n": {}}, "target": {"p": {}, "n": {}}}
+
+
+def counter_value(pn):
+    return sum(pn.get("p", {}).values()) - sum(pn.get("n", {}).values())
+
+
+def merge_counter(a, b):
+    out = {}
+    for side in ("p", "n"):
+        merged = dict(a.get(side, {}))
+        for replica, n in b.get(side, {}).items():
+            merged[replica] = max(merged.get(replica, 0), n)
+        out[side] = merged
+    return out
+
+
+def merge(a, b):
+    return {
+        "adds": sorted(set(a.get("adds", [])) | set(b.get("adds", []))),
+        "removes": sorted(set(a.get("removes", [])) | set(b.get("removes", []))),
+        "current": merge_counter(a.get("current", {}), b.get("current", {})),
+        "target": merge_counter(a.get("target", {}), b.get("target", {})),
+    }
+
+
+def is_present(item):
+    return bool(set(item["adds"]) - set(item["removes"]))
+
+
+def values(item):
+    return counter_value(item["current"]), counter_value(item["target"])
+
+
+def row_digest(name, current, target, acquired=0):
+    """Digest of an item's materialized row. A server list's version is the XOR
+    of its rows' digests, so it is updated one item at a time."""
+    body = json.dumps([name, current, target, acquired], separators=(",", ":")).encode()
+    return int.from_bytes(hashlib.blake2b(body, digest_size=7).digest(), "big")
+
+
+def bump_version(c, list_id, change):
+    """XOR a change (old row digest ^ new) into a server list's stored version."""
+    if not change:
+        return
+    c.execute("SELECT version FROM shopping_lists WHERE id=?", (list_id,))
+    row = c.fetchone()
+    if row is not None:
+        c.execute("UPDATE shopping_lists SET version=? WHERE id=?", (row[0] ^ change, list_id))
+
+
+def _counter_delta(pn, replica, amount):
+    if amount > 0:
+        return {"p": {replica: pn["p"].get(replica, 0) + amount}, "n": {}}
+    if amount < 0:
+        return {"p": {}, "n": {replica: pn["n"].get(replica, 0) - amount}}
+    return {"p": {}, "n": {}}
+
+
+def set_delta(item, replica, current, target):
+    """Delta moving the item's quantities to the given values."""
+    cur, tgt = values(item)
+    return {"current": _counter_delta(item["current"], replica, current - cur),
+            "target": _counter_delta(item["target"], replica, target - tgt)}
+
+
+def add_delta(item, replica, dot, current, target):
+    delta = set_delta(item, replica, current, target)
+    delta["adds"] = [dot]
+    return delta
+
+
+def remove_delta(item):
+    return {"removes": sorted(set(item["adds"]) - set(item["removes"]))}
+
+
+def next_dot(c, replica):
+    """Allocate the next dot for this replica from the store's meta table."""
+    c.execute("INSERT OR IGNORE INTO meta(key, value) VALUES ('dot_counter', '0')")
+    c.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key='dot_counter'")
+    c.execute("SELECT value FROM meta WHERE key='dot_counter'")
+    return f"{replica}:{c.fetchone()[0]}"
+
+
+def load_item(c, list_id, name):
+    c.execute("SELECT state FROM item_state WHERE list_id=? AND name=?", (list_id, name))
+    row = c.fetchone()
+    return json.loads(row[0]) if row else new_item()
+
+
+def merge_into(c, list_id, name, delta):
+    """Merge a delta into the stored state. Returns (state, changed)."""
+    old = load_item(c, list_id, name)
+    state = merge(old, delta)
+    if state == old:
+        return state, False
+    c.execute("""INSERT INTO item_state(list_id, name, state) VALUES (?, ?, ?)
+                 ON CONFLICT(list_id, name) DO UPDATE SET state=excluded.state""",
+              (list_id, name, json.dumps(state, separators=(",", ":"))))
+    return state, True
@@ -11,3 +11,50 @@ CREATE TABLE IF NOT EXISTS items (
     acquired_flag INTEGER,
     FOREIGN KEY(list_id) REFERENCES shopping_lists(id)
 );
+
+CREATE UNIQUE INDEX IF NOT EXISTS items_key ON items(list_id, name);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS changes (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    list_id TEXT,
+    name TEXT
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS changes_key ON changes(list_id, name);
+
+CREATE TABLE IF NOT EXISTS item_state (
+    list_id TEXT,
+    name TEXT,
+    state TEXT,
+    PRIMARY KEY(list_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS handoff (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    node TEXT,
+    list_id TEXT,
+    request TEXT,
+    sent_at REAL,
+    snapshot TEXT
+);
+
+CREATE INDEX IF NOT EXISTS handoff_node ON handoff(node);
+
+CREATE UNIQUE INDEX IF NOT EXISTS handoff_transfer ON handoff(node, list_id) WHERE request IS NULL;
+
+CREATE INDEX IF NOT EXISTS handoff_due ON handoff(sent_at);
+
+CREATE INDEX IF NOT EXISTS handoff_snapshot ON handoff(snapshot);
+
+CREATE TABLE IF NOT EXISTS snapshot_chunks (
+    id TEXT,
+    seq INTEGER,
+    data TEXT,
+    received_at REAL,
+    PRIMARY KEY(id, seq)
+);
@@ -1,37 +1,125 @@
 import hashlib
 import bisect
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:  # pure-Python fallback, same placement
+    np = None
+
 
 class HashRing:
-    def __init__(self, replicas=100):
+    # Identifies the token hash; rings built with a different one place keys differently.
+    HASH = "blake2b-64"
+
+    def __init__(self, replicas=100, cache_size=65536):
         self.replicas = replicas
-        self.ring = {}
-        self.sorted_keys = []
+        self.nodes = []     # node id per slot (None once removed)
+        self.index = {}     # node id -> slot
+        self.free = []      # removed nodes' slots, reused by the next nodes added
+        self.sorted_keys = []  # sorted tokens, parallel to owners
+        self.owners = []       # slot owning each token
+        # NumPy copies for bulk rebuilds and batched lookups
+        self._token_array = np.empty(0, dtype=np.uint64) if np else None
+        self._owner_array = np.empty(0, dtype=np.int32) if np else None
+        self._preference = lru_cache(maxsize=cache_size)(self._compute_nodes)
+
+    @staticmethod
+    def _hash(key):
+        """Return a 64-bit hash of the key (blake2b, 8-byte digest)."""
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def _set_tokens(self, tokens, owners):
+        if np is not None:
+            order = np.argsort(tokens, kind="stable")
+            self._token_array = tokens[order]
+            self._owner_array = owners[order]
+            self.sorted_keys = self._token_array.tolist()
+            self.owners = self._owner_array.tolist()
+        else:
+            pairs = sorted(zip(tokens, owners))
+            self.sorted_keys = [t for t, _ in pairs]
+            self.owners = [o for _, o in pairs]
+        self._preference.cache_clear()
+
+    def add_nodes(self, node_ids):
+        """Add several nodes (servers) to the ring with a single rebuild."""
+        new = [n for n in dict.fromkeys(node_ids) if n not in self.index]
+        if not new:
+            return
+        tokens, owners = [], []
+        for node_id in new:
+            if self.free:
+                slot = self.free.pop()
+                self.nodes[slot] = node_id
+            else:
+                slot = len(self.nodes)
+                self.nodes.append(node_id)
+            self.index[node_id] = slot
+            tokens.extend(self._hash(f"{node_id}:{i}") for i in range(self.replicas))
+            owners.extend([self.index[node_id]] * self.replicas)
 
-    def _hash(self, key):
-        """Return a SHA-256 based hash value (0..2^256-1)."""
-        return int(hashlib.sha256(key.encode("utf-8")).hexdigest(), 16)
+        if np is not None:
+            self._set_tokens(np.concatenate([self._token_array, np.array(tokens, dtype=np.uint64)]),
+                             np.concatenate([self._owner_array, np.array(owners, dtype=np.int32)]))
+        else:
+            self._set_tokens(self.sorted_keys + tokens, self.owners + owners)
+
+    def remove_nodes(self, node_ids):
+        """Remove several nodes (servers) from the ring with a single rebuild."""
+        slots = [self.index.pop(n) for n in dict.fromkeys(node_ids) if n in self.index]
+        if not slots:
+            return
+        for slot in slots:
+            self.nodes[slot] = None
+        self.free.extend(slots)
+
+        if np is not None:
+            keep = ~np.isin(self._owner_array, slots)
+            self._set_tokens(self._token_array[keep], self._owner_array[keep])
+        else:
+            gone = set(slots)
+            pairs = [(t, o) for t, o in zip(self.sorted_keys, self.owners) if o not in gone]
+            self._set_tokens([t for t, _ in pairs], [o for _, o in pairs])
 
     def add_node(self, node_id):
         """Add a node (server) to the ring."""
-        for i in range(self.replicas):
-            h = self._hash(f"{node_id}:{i}")
-            self.ring[h] = node_id
-            bisect.insort(self.sorted_keys, h)
+        self.add_nodes([node_id])
 
     def remove_node(self, node_id):
         """Remove a node (server) from the ring."""
-        for i in range(self.replicas):
-            h = self._hash(f"{node_id}:{i}")
-            if h in self.ring:
-                del self.ring[h]
-                self.sorted_keys.remove(h)
+        self.remove_nodes([node_id])
+
+    def _compute_nodes(self, key, n):
+        count = len(self.owners)
+        if not count:
+            return ()
+        start = bisect.bisect(self.sorted_keys, self._hash(key))
+        slots = []
+        for i in range(count):
+            slot = self.owners[(start + i) % count]
+            if slot not in slots:
+                slots.append(slot)
+                if len(slots) == n:
+                    break
+        return tuple(self.nodes[s] for s in slots)
 
     def get_node(self, key):
         """Return the node responsible for the given key."""
-        if not self.ring:
-            return None
-        h = self._hash(key)
-        idx = bisect.bisect(self.sorted_keys, h)
-        if idx == len(self.sorted_keys):
-            idx = 0
-        return self.ring[self.sorted_keys[idx]]
\ No newline at end of file
+        nodes = self._preference(key, 1)
+        return nodes[0] if nodes else None
+
+    def get_nodes(self, key, n):
+        """Return up to n distinct nodes for the key, walking clockwise (its preference list)."""
+        return list(self._preference(key, n))
+
+    def get_nodes_for(self, keys):
+        """Return the responsible node for each key, looked up in one vectorized pass."""
+        if np is None or not len(self.owners):
+            return [self.get_node(key) for key in keys]
+        hashes = np.fromiter((self._hash(key) for key in keys), dtype=np.uint64, count=len(keys))
+        positions = np.searchsorted(self._token_array, hashes, side="right") % len(self.owners)
+        return [self.nodes[s] for s in self._owner_array[positions].tolist()]
+
+    def cache_info(self):
+        return self._preference.cache_info()
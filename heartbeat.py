@@ -0,0 +1,108 @@
+import heapq
+import math
+from collections import deque
+from statistics import NormalDist
+
+# Failure detection for the proxy's view of its servers (phi accrual).
+#
+# Servers ping every HEARTBEAT_INTERVAL seconds. For each server the detector
+# keeps the recent gaps between pings and, from their mean and deviation, how
+# suspicious the current silence is: phi = -log10(P(gap >= silence)). A server
+# is suspected once phi passes PHI_THRESHOLD, so a server with jittery pings
+# gets more slack than one that is always on time.
+#
+# Any message from a server counts as a sign of life, but only pings feed the
+# gap statistics, since data traffic says nothing about the ping rhythm.
+# Each server has one deadline in a heap: the time its phi would cross the
+# threshold if nothing else arrived. Checking for failures pops the deadlines
+# that have passed; one whose server was heard from since is pushed back with
+# a fresh deadline. The cost of a check is the number of due deadlines, not
+# the number of servers.
+
+HEARTBEAT_INTERVAL = 3.0
+PHI_THRESHOLD = 8.0
+HISTORY = 100          # ping gaps kept per server
+MIN_STD = 0.5          # floor for the deviation, so a perfectly regular server is not suspected on the first jitter
+ACCEPTABLE_PAUSE = 2.0  # extra silence always tolerated (GC, slow disk)
+
+
+class FailureDetector:
+    def __init__(self, threshold=PHI_THRESHOLD, history=HISTORY, min_std=MIN_STD, pause=ACCEPTABLE_PAUSE):
+        self.threshold = threshold
+        self.history = history
+        self.min_std = min_std
+        self.pause = pause
+        self.last_ping = {}  # node -> time of its last ping
+        self.last_seen = {}  # node -> time of the last message of any kind
+        self.gaps = {}       # node -> recent gaps between pings
+        self.deadline = {}   # node -> the one live deadline in the heap
+        self.heap = []
+
+    def __contains__(self, node):
+        return node in self.deadline
+
+    def __len__(self):
+        return len(self.deadline)
+
+    def heartbeat(self, node, now, interval=HEARTBEAT_INTERVAL):
+        """Record a ping. interval is the rhythm the node announced, used until it has history."""
+        gaps = self.gaps.get(node)
+        if gaps is None:
+            # A single assumed gap, so the first estimate is the announced rhythm.
+            gaps = self.gaps[node] = deque([interval], maxlen=self.history)
+        elif node in self.last_ping:
+            gaps.append(now - self.last_ping[node])
+        self.last_ping[node] = now
+        self.last_seen[node] = now
+        if node not in self.deadline:
+            self._schedule(node)
+
+    def seen(self, node, now):
+        """Record any other message from the node. Only a ping brings back a suspected node."""
+        if node in self.deadline:
+            self.last_seen[node] = now
+
+    def forget(self, node):
+        """Stop watching the node. Its ping history is kept for when it comes back."""
+        self.deadline.pop(node, None)
+        self.last_seen.pop(node, None)
+        self.last_ping.pop(node, None)
+
+    def _stats(self, node):
+        gaps = self.gaps[node]
+        mean = sum(gaps) / len(gaps)
+        var = sum((g - mean) ** 2 for g in gaps) / len(gaps)
+        return mean + self.pause, max(math.sqrt(var), self.min_std)
+
+    def _timeout(self, node):
+        """Silence after which the node's phi reaches the threshold."""
+        mean, std = self._stats(node)
+        return NormalDist(mean, std).inv_cdf(1.0 - 10 ** -self.threshold)
+
+    def phi(self, node, now):
+        """Suspicion level for the node right now; 0 when it is not watched."""
+        if node not in self.deadline:
+            return 0.0
+        mean, std = self._stats(node)
+        p_later = 1.0 - NormalDist(mean, std).cdf(now - self.last_seen[node])
+        return -math.log10(max(p_later, 1e-300))
+
+    def _schedule(self, node):
+        deadline = self.last_seen[node] + self._timeout(node)
+        self.deadline[node] = deadline
+        heapq.heappush(self.heap, (deadline, node))
+
+    def expired(self, now):
+        """Nodes whose phi passed the threshold since the last call. They are no
+        longer watched until they are heard from again."""
+        suspected = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, node = heapq.heappop(self.heap)
+            if self.deadline.get(node) != deadline:
+                continue  # superseded or forgotten
+            if self.last_seen[node] + self._timeout(node) > now:
+                self._schedule(node)  # heard from after this deadline was set
+            else:
+                suspected.append(node)
+                self.forget(node)
+        return suspected
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import bisect
+import threading
+from collections import deque
+
+# In-process counters, gauges and latency histograms, replacing per-request
+# printing. Each process keeps one Registry (REGISTRY below). Its snapshot is
+# plain JSON: the proxy answers it to the "metrics" op together with the
+# snapshots of its servers, and any process can dump it to a file
+# periodically.
+#
+# Names are dotted, e.g. "proxy.latency.get_info". Histograms count values
+# into power-of-two buckets from 1 us up, so recording costs a bisect over
+# a short list. Percentiles in a snapshot are bucket upper bounds, within a
+# factor of two of the true value.
+#
+# Tracing: a request that carries a "trace" list of [hop, timestamp] pairs
+# gets a stamp from every process it passes through, and the reply brings the
+# list back. The requester records the gaps between consecutive stamps as
+# "trace.<hop>-><hop>" histograms and keeps the latest traces, keyed by the
+# request's req_id.
+
+BUCKETS = [1e-6 * 2 ** i for i in range(25)]  # 1 us .. ~16 s
+DUMP_INTERVAL = 10.0
+TRACES_KEPT = 100
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return 0.0
+
+    def snapshot(self):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "mean": self.total / self.count, "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9), "p99": self.percentile(0.99), "max": self.max}
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}  # name -> function returning the current value
+        self.traces = deque(maxlen=TRACES_KEPT)
+        self.started = time.time()
+
+    def inc(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, read):
+        """Register a value that is read when a snapshot is taken (queue depths, cache sizes)."""
+        self.gauges[name] = read
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def trace(self, req_id, stamps):
+        """Record a finished trace: the gaps between its stamps, and the trace itself."""
+        with self.lock:
+            for (a, ta), (b, tb) in zip(stamps, stamps[1:]):
+                key = f"trace.{a}->{b}"
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.observe(max(0.0, tb - ta))
+            self.traces.append({"req_id": req_id, "hops": stamps})
+
+    def snapshot(self):
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        with self.lock:
+            return {"time": time.time(), "uptime": time.time() - self.started, "pid": os.getpid(),
+                    "counters": dict(self.counters), "gauges": gauges,
+                    "histograms": {name: h.snapshot() for name, h in self.histograms.items()},
+                    "traces": list(self.traces)}
+
+    def dump(self, path):
+        """Write a snapshot to path, replacing the previous one atomically."""
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+
+class Timer:
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+
+
+def stamp(msg, hop):
+    """Add this hop to a traced message; untraced messages are left alone."""
+    trace = msg.get("trace")
+    if trace is not None:
+        trace.append([hop, time.time()])
+
+
+REGISTRY = Registry()
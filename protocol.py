@@ -0,0 +1,114 @@
+import json
+
+try:
+    import msgpack
+except ImportError:  # JSON only
+    msgpack = None
+
+# Client requests travel as two frames: a small routing header and the body.
+# The header holds what the proxy needs to route the request (op,
+# correlation id and list id), so the body is forwarded without being parsed.
+# Single-frame requests are still accepted; the proxy then parses the body.
+#
+# Bodies are JSON or, where every hop has it installed, msgpack. A JSON body
+# always starts with "{" and a msgpack map never does, so receivers tell them
+# apart by the first byte and reply in the format they were addressed in.
+# Which format a peer sends is negotiated on ping: it lists the formats it can
+# read and the pong names the one to use. JSON is the fallback everywhere.
+
+SEP = "\x00"
+JSON = "json"
+MSGPACK = "msgpack"
+FORMATS = [MSGPACK, JSON] if msgpack else [JSON]
+
+
+# Plain item ops (create_item, update_item, delete_item) are turned into a
+# CRDT delta by the one replica that applies them. It answers with that delta
+# under "delta" (item name -> delta), and the proxy sends the same delta to the
+# other replicas as a merge, so all of them hold the same state.
+ITEM_OPS = {"create_item", "update_item", "delete_item"}
+
+# Routing frame used in place of a client identity for sub-requests whose
+# replies the proxy collects itself. Client identities never start with 0x00.
+PENDING_PREFIX = b"\x00pending-"
+# Ops only a proxy may send: membership notices (rebalance, handoff) go out
+# under CONTROL_ROUTE, and server-to-server requests (snapshot chunks) under a
+# relay route, which carries RELAY_MARK. Proxies refuse them from clients and
+# servers run them under no other route.
+SERVER_OPS = {"rebalance", "handoff", "snapshot", "relay"}
+CONTROL_ROUTE = PENDING_PREFIX + b"control"
+RELAY_MARK = b"relay-"
+
+
+def from_proxy(route_id):
+    """True if a request's routing frame shows the proxy itself sent it."""
+    return route_id == CONTROL_ROUTE or (route_id.startswith(PENDING_PREFIX) and RELAY_MARK in route_id)
+
+
+def as_merge(list_id, delta):
+    """The merge request applying an item op's delta elsewhere."""
+    return {"op": "merge", "list_id": list_id, "payload": {"items": delta}}
+
+
+def pack_header(op, req_id=None, list_id=None):
+    # list_id goes last so it may contain anything, separators included.
+    return SEP.join("" if v is None else str(v) for v in (op, req_id, list_id)).encode()
+
+
+def unpack_header(frame):
+    """Return (op, req_id, list_id); empty fields come back as None."""
+    op, req_id, list_id = frame.decode().split(SEP, 2)
+    return op, req_id or None, list_id or None
+
+
+def format_of(body):
+    return JSON if bytes(body[:1]) == b"{" else MSGPACK
+
+
+def encode(msg, fmt=JSON):
+    if fmt == MSGPACK:
+        return msgpack.packb(msg, use_bin_type=True)
+    return json.dumps(msg).encode()
+
+
+def decode(body):
+    if format_of(body) == JSON:
+        return json.loads(body)
+    if msgpack is None:
+        raise ValueError("Got a msgpack message but msgpack is not installed")
+    return msgpack.unpackb(body, raw=False)
+
+
+def plain_ok(body):
+    """True if an encoded reply has status "ok" and carries no trace, judged from
+    its bytes alone so it can be forwarded without decoding. Replies put
+    "status" first; a reply this misses is simply decoded."""
+    if format_of(body) == JSON:
+        if not (body.startswith(b'{"status": "ok"') and body[15:16] in (b",", b"}")):
+            return False
+        return b'"trace"' not in body
+    return body[1:11] == b"\xa6status\xa2ok" and b"\xa5trace" not in body
+
+
+def negotiate(offered, supported=FORMATS):
+    """The first of the peer's formats that we support too."""
+    for fmt in offered or []:
+        if fmt in supported:
+            return fmt
+    return JSON
+
+
+def with_req_id(body, req_id):
+    """Add a req_id to an encoded reply without re-encoding the rest of it."""
+    if req_id is None:
+        return body
+    if format_of(body) == JSON:
+        return body[:-1] + b', "req_id": ' + json.dumps(req_id).encode() + b"}"
+    if 0x80 <= body[0] < 0x8f:  # fixmap with room for one more key
+        return bytes([body[0] + 1]) + body[1:] + msgpack.packb("req_id") + msgpack.packb(req_id)
+    return encode(dict(decode(body), req_id=req_id), MSGPACK)
+
+
+def request_frames(msg, fmt=JSON):
+    """Frames for a client request: routing header, then the body."""
+    return [pack_header(msg.get("op"), msg.get("req_id"), msg.get("list_id")), encode(msg, fmt)]
@@ -1,116 +1,681 @@
 import zmq
-import json
 import time
+import argparse
+import heapq
+import uuid
+import os
+import threading
+import multiprocessing
 from hashring import HashRing
+from heartbeat import FailureDetector, HEARTBEAT_INTERVAL
+from metrics import REGISTRY, DUMP_INTERVAL
+from protocol import (unpack_header, encode, decode, format_of, negotiate, plain_ok, as_merge, ITEM_OPS, SERVER_OPS,
+                      PENDING_PREFIX, CONTROL_ROUTE, RELAY_MARK, FORMATS, JSON)
 
-def start_proxy(proxy_port_clients, proxy_port_servers, proxy_name):
-    context = zmq.Context()
-    frontend = context.socket(zmq.ROUTER)
-    frontend.bind(f"tcp://*:{proxy_port_clients}")
-    backend = context.socket(zmq.ROUTER)
-    backend.bind(f"tcp://*:{proxy_port_servers}")
+REQUEST_TIMEOUT = 2.0
+# A snapshot chunk may carry a whole import, which takes far longer than a request.
+SNAPSHOT_TIMEOUT = 60.0
+# A server the failure detector suspects is first marked down: it keeps its place on the
+# ring and writes for it go to a stand-in with a hint. Only after this long is
+# it removed from the ring and its lists rebalanced to the remaining nodes.
+DECOMMISSION_TIMEOUT = 120
+REBALANCE_DELAY = 2.0
+# Ops that every server answers for its own share of the data. A "metrics"
+# reply also carries the proxy's own snapshot; list_all_lists pages from all
+# servers are merged into one (see merge_list_pages).
+BROADCAST_OPS = {"changes_since", "metrics", "list_all_lists"}
+READ_OPS = {"get_info"}
+# Statuses that answer an op; anything else sends a read on to a spare replica.
+# "not_modified" is a get_info whose if_version is still current.
+ANSWERED = {"ok", "not_modified"}
+# Worker processes per proxy. With more than one, an Acceptor owns the public
+# ports and the workers do the routing.
+PROXY_WORKERS = 1
 
-    print(f"{proxy_name} started.")
-    print(f"Clients: {proxy_port_clients}, Servers: {proxy_port_servers}")
+# Replication: each list lives on the first N nodes of its preference list.
+# Writes go to all N and are acknowledged after W succeed. A plain item op goes
+# to the first replica only; the delta it answers with is then merged into the
+# others (see protocol.ITEM_OPS) and their acks count toward W. Reads go to the R
+# least loaded replicas (fewest requests in flight, then lowest latency) and
+# the first success is returned.
+REPLICAS_N = 2
+READ_R = 1
+WRITE_W = 1
 
-    poller = zmq.Poller()
-    poller.register(frontend, zmq.POLLIN)
-    poller.register(backend, zmq.POLLIN)
+# Backpressure: at most this many requests are in flight to one server. Reads
+# avoid a saturated replica; an op with nowhere to go is answered "busy" at
+# once. Writes are not moved to another node, so a write is busy while any of
+# its replicas is saturated. With several workers each one keeps its own count.
+HIGH_WATER = 1000
+BUSY = {"status": "busy", "message": "Server saturated, retry later"}
 
-    ring = HashRing()
-    servers = {}
-    MAX_SERVERS = 5
 
-    while True:
+class Proxy:
+    def __init__(self, proxy_port_clients, proxy_port_servers, proxy_name,
+                 n=REPLICAS_N, r=READ_R, w=WRITE_W, dump=None, worker=None, high_water=HIGH_WATER):
+        self.name = proxy_name
+        self.high_water = high_water
+        # Metrics file, written every DUMP_INTERVAL; each worker writes its own.
+        self.dump = f"{dump}.w{worker}" if dump and worker is not None else dump
+        self.next_dump = 0
+        self.context = zmq.Context()
+        if worker is None:
+            self.tag = b""
+            self.primary = True
+            self.frontend = self.context.socket(zmq.ROUTER)
+            self.frontend.bind(f"tcp://*:{proxy_port_clients}")
+            self.backend = self.context.socket(zmq.ROUTER)
+            # Servers keep their identity across restarts; let a reconnect take over the old one.
+            self.backend.setsockopt(zmq.ROUTER_HANDOVER, 1)
+            self.backend.bind(f"tcp://*:{proxy_port_servers}")
+            print(f"{proxy_name} started.")
+            print(f"Clients: {proxy_port_clients}, Servers: {proxy_port_servers}")
+        else:
+            # Behind an Acceptor the ports are its loopback ones. Frames arrive
+            # exactly as the ROUTER sockets would deliver them.
+            self.tag = worker_id(worker) + b":"
+            # Only the primary worker answers pings and talks to servers on the proxy's behalf.
+            self.primary = worker == 0
+            self.frontend = self.context.socket(zmq.DEALER)
+            self.frontend.connect(f"tcp://127.0.0.1:{proxy_port_clients}")
+            self.backend = self.context.socket(zmq.DEALER)
+            self.backend.setsockopt(zmq.IDENTITY, worker_id(worker))
+            self.backend.connect(f"tcp://127.0.0.1:{proxy_port_servers}")
+            print(f"{proxy_name} worker {worker} started.")
+        if self.primary:
+            print(f"Replication: N={n}, R={r}, W={w}")
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.frontend, zmq.POLLIN)
+        self.poller.register(self.backend, zmq.POLLIN)
+
+        self.ring = HashRing()
+        self.servers = {}     # live server identity -> time it joined or came back
+        self.detector = FailureDetector()
+        self.identities = {}  # ring node name -> server identity frame
+        self.formats = {}     # server identity -> body formats it can read
+        self.down = {}        # down server identity -> when it is decommissioned
+        self.pending = {}
+        self.relays = {}
+        # Deadlines as (time, key) heaps, so each check costs only what is due.
+        self.timeouts = []        # pending and relay tokens
+        self.decommissions = []   # down servers
+        self.rebalance_at = None
+        self.latency = {}
+        self.in_flight = {}   # server identity -> requests sent and not yet answered
+        self.counters = {}    # server identity -> {"sent", "busy", "timeouts"}
+        self.now = time.time()
+        self.n = n
+        self.r = max(1, min(r, n))
+        self.w = max(1, min(w, n))
+
+        self.metrics = REGISTRY
+        self.metrics.gauge("proxy.pending", lambda: len(self.pending))
+        self.metrics.gauge("proxy.servers_up", lambda: len(self.servers))
+        self.metrics.gauge("proxy.servers_down", lambda: len(self.down))
+        self.metrics.gauge("proxy.in_flight", lambda: {sid.decode(): n for sid, n in self.in_flight.items()})
+        self.metrics.gauge("proxy.ring_cache", lambda: self.ring.cache_info()._asdict())
+
+    def run(self):
+        while True:
+            try:
+                events = dict(self.poller.poll(1000))
+                self.now = time.time()
+
+                # Frames are received and forwarded without copying the bodies.
+                if events.get(self.backend) == zmq.POLLIN:
+                    self.handle_server(self.backend.recv_multipart(copy=False))
+
+                if events.get(self.frontend) == zmq.POLLIN:
+                    self.handle_client(self.frontend.recv_multipart(copy=False))
+
+                self.expire(self.now)
+                if self.dump and self.now >= self.next_dump:
+                    self.metrics.dump(self.dump)
+                    self.next_dump = self.now + DUMP_INTERVAL
+
+            except KeyboardInterrupt:
+                print("\nProxy shutting down...")
+                break
+            except Exception as e:
+                print(f"Error in {self.name}: {e}")
+
+    def announce(self, text):
+        # Every worker sees the same membership changes; only the primary reports them.
+        if self.primary:
+            print(text)
+
+    def handle_server(self, frames):
+        server_id = frames[0].bytes
+        if len(frames) == 3:
+            # Replies count as signs of life as much as pings do.
+            self.detector.seen(server_id, self.now)
+            client_id, msg = frames[1].bytes, frames[2]
+            if client_id in self.relays:
+                self.backend.send_multipart([self.relays.pop(client_id)[0], msg])
+            elif client_id.startswith(PENDING_PREFIX):
+                self.collect(server_id, client_id, msg)
+            else:
+                self.frontend.send_multipart([client_id, msg])
+            return
+
         try:
-            events = dict(poller.poll(1000))
-            
-            if backend in events and events[backend] == zmq.POLLIN:
-                frames = backend.recv_multipart()
-
-                if len(frames) == 3:
-                    server_id, client_id, msg = frames
-                    frontend.send_multipart([client_id, msg])
-                    continue
-
-                server_id, msg = frames[0], frames[-1]
-                try:
-                    req = json.loads(msg.decode())
-                    if req.get("op") == "ping":
-                        backend.send_multipart([server_id, json.dumps({"status": "pong"}).encode()])
-                        if server_id not in servers:
-                            if len(servers) < MAX_SERVERS:
-                                servers[server_id] = time.time()
-                                ring.add_node(server_id.decode())
-                                print(f"[+] Added {server_id.decode()} to hash ring.")
-                        else:
-                            servers[server_id] = time.time()
-                        continue
-                except Exception:
-                    pass
-
-            if frontend in events and events[frontend] == zmq.POLLIN:
-                frames = frontend.recv_multipart()
-                client_id, msg = frames[0], frames[-1]
-                req = json.loads(msg.decode())
-
-                if req.get("op") == "ping":
-                    frontend.send_multipart([client_id, json.dumps({"status": "pong"}).encode()])
-                    continue
-
-                list_id = req.get("list_id")
-                target_server_name = ring.get_node(list_id or "global")
-                if not target_server_name:
-                    frontend.send_multipart([
-                        client_id,
-                        json.dumps({"status": "error", "message": "No servers available"}).encode()
-                    ])
-                    continue
-
-                target_server = None
-                for sid in servers.keys():
-                    if sid.decode() == target_server_name:
-                        target_server = sid
-                        break
-
-                if not target_server:
-                    frontend.send_multipart([
-                        client_id,
-                        json.dumps({"status": "error", "message": "Server not found"}).encode()
-                    ])
-                    continue
-
-                backend.send_multipart([target_server, client_id, msg])
-                print(f"-> Routed {req['op']} for list '{list_id}' - {target_server.decode()}")
-
-            now = time.time()
-            for sid, last in list(servers.items()):
-                if now - last > 10:
-                    ring.remove_node(sid.decode())
-                    del servers[sid]
-                    print(f"[-] Removed {sid.decode()} (timeout)")
-
-        except KeyboardInterrupt:
-            print("\nProxy shutting down...")
-            break
-        except Exception as e:
-            print(f"Error in {proxy_name}: {e}")
+            req = decode(frames[-1].bytes)
+        except Exception:
+            return
+        fmt = format_of(frames[-1].buffer)
+        if req.get("op") == "ping":
+            self.formats[server_id] = req.get("formats", [JSON])
+            if self.primary:
+                pong = {"status": "pong", "format": negotiate(req.get("formats"))}
+                self.backend.send_multipart([server_id, encode(pong, fmt)])
+            self.detector.heartbeat(server_id, self.now, req.get("interval", HEARTBEAT_INTERVAL))
+            if server_id in self.servers:
+                return
+            self.servers[server_id] = self.now
+            if server_id in self.down:
+                del self.down[server_id]
+                self.announce(f"[+] {server_id.decode()} is back.")
+                self.control("handoff", {"node": server_id.decode()})
+            else:
+                self.identities[server_id.decode()] = server_id
+                self.ring.add_node(server_id.decode())
+                self.announce(f"[+] Added {server_id.decode()} to hash ring.")
+                self.control("handoff", {"node": server_id.decode()})
+                self.rebalance_at = self.now + REBALANCE_DELAY
+        else:
+            self.detector.seen(server_id, self.now)
+            if req.get("op") == "relay" and self.primary:
+                self.relay(server_id, req, fmt)
+
+    def handle_client(self, frames):
+        client_id, msg = frames[0].bytes, frames[-1]
+        fmt = format_of(msg.buffer)
+        if len(frames) == 3:
+            # Routing header present: the body is not parsed unless it has to be rewritten.
+            op, req_id, list_id = unpack_header(frames[1].bytes)
+            req = {"op": op, "list_id": list_id, "req_id": req_id}
+        else:
+            req = decode(msg.bytes)
+            op = req.get("op")
+
+        self.metrics.inc(f"proxy.requests.{op}")
+        if op == "stats":
+            self.reply_to(client_id, req, self.stats(), fmt)
+        elif op == "ping":
+            # Bodies reach the servers as they are, so offer only what every server reads.
+            offered = decode(msg.bytes).get("formats")
+            self.reply_to(client_id, req, {"status": "pong", "format": negotiate(offered, self.readable(self.servers))}, fmt)
+        elif op == "batch":
+            ops = req["ops"] if "ops" in req else decode(msg.bytes).get("ops", [])
+            self.metrics.observe("proxy.batch_size", len(ops))
+            self.route(client_id, req, ops, None, fmt)
+        elif op in SERVER_OPS:
+            self.reply_to(client_id, req, {"status": "error", "message": "Not allowed"}, fmt)
+        elif op in BROADCAST_OPS:
+            self.broadcast(client_id, req, msg, fmt)
+        else:
+            self.route(client_id, req, [req], msg, fmt)
+
+    def reply_to(self, client_id, req, reply, fmt=JSON):
+        """Answer a client directly from the proxy, echoing its correlation id."""
+        if req.get("req_id") is not None:
+            reply["req_id"] = req["req_id"]
+        with self.metrics.timer("proxy.encode"):
+            body = encode(reply, fmt)
+        self.frontend.send_multipart([client_id, body])
+
+    def saturated(self, sid):
+        return self.in_flight.get(sid, 0) >= self.high_water
+
+    def count(self, sid, counter):
+        counters = self.counters.setdefault(sid, {"sent": 0, "busy": 0, "timeouts": 0})
+        counters[counter] += 1
+
+    def stats(self):
+        """Per-server load as this proxy (or worker) sees it."""
+        servers = {}
+        for sid in list(self.servers) + list(self.down):
+            servers[sid.decode()] = dict(self.counters.get(sid, {"sent": 0, "busy": 0, "timeouts": 0}),
+                                         up=sid in self.servers,
+                                         in_flight=self.in_flight.get(sid, 0),
+                                         latency_ms=round(self.latency.get(sid, 0) * 1000, 3),
+                                         phi=round(self.detector.phi(sid, self.now), 3))
+        return {"status": "ok", "proxy": self.name, "worker": self.tag.decode().rstrip(":") or None,
+                "high_water": self.high_water, "servers": servers}
+
+    def readable(self, sids):
+        """Formats this proxy and every one of the given servers can read."""
+        return [f for f in FORMATS if all(f in self.formats.get(sid, [JSON]) for sid in sids)]
+
+    def replicas(self, list_id):
+        """Live servers for the list in preference order, each paired with the
+        down node it is standing in for (or None)."""
+        names = self.ring.get_nodes(list_id or "global", self.n + len(self.down))
+        stand_ins = [self.identities[name] for name in names[self.n:] if self.identities[name] in self.servers]
+        targets = []
+        for name in names[:self.n]:
+            sid = self.identities[name]
+            if sid in self.servers:
+                targets.append((sid, None))
+            elif stand_ins:
+                targets.append((stand_ins.pop(0), name))
+        return targets
+
+    def control(self, op, payload):
+        """Notify every live server; the replies are not needed."""
+        if not self.primary:
+            return
+        msg = {"op": op, "payload": payload}
+        for sid in self.servers:
+            self.backend.send_multipart([sid, CONTROL_ROUTE, encode(msg, self.readable([sid])[0])])
+
+    def relay(self, origin, req, fmt=JSON):
+        """Forward a server-to-server request (rebalance transfer or hinted write)."""
+        target = req.get("target", "").encode()
+        request = req.get("request", {})
+        if target not in self.servers:
+            reply = {"status": "error", "message": "Target not available", "req_id": request.get("req_id")}
+            self.backend.send_multipart([origin, encode(reply, fmt)])
+            return
+        token = PENDING_PREFIX + self.tag + RELAY_MARK + uuid.uuid4().hex.encode()
+        expires = time.time() + (SNAPSHOT_TIMEOUT if request.get("op") == "snapshot" else REQUEST_TIMEOUT)
+        self.relays[token] = (origin, request.get("req_id"), fmt)
+        heapq.heappush(self.timeouts, (expires, token))
+        # The target's reply goes back to the origin as it is, so both must read it.
+        self.backend.send_multipart([target, token, encode(request, self.readable([origin, target])[0])])
+
+    def _entry(self, client_id, req, ops, msg, fmt):
+        count = len(ops)
+        return {"client": client_id, "req": req, "ops": ops, "msg": msg, "single": msg is not None, "fmt": fmt,
+                "done": False, "results": [None] * count, "errors": [None] * count, "spare": {}, "followers": {},
+                "acks": [0] * count, "needed": [1] * count, "open": count, "waiting": 0,
+                "received": self.now, "expires": time.time() + REQUEST_TIMEOUT}
+
+    def _send_op(self, entry, target, indexes, hints=None):
+        """Send ops to one server. A single unhinted request is forwarded as is,
+        anything else goes as a sub-batch."""
+        hints = hints or {}
+        batched = not entry["single"] or bool(hints)
+        if batched:
+            ops = entry["ops"]
+            if entry["single"]:
+                # Only the routing header was read; the hint goes into the full request.
+                ops = [decode(entry["msg"].bytes)]
+            ops = [dict(ops[i], hint=hints[i]) if i in hints else ops[i] for i in indexes]
+            body = encode({"op": "batch", "ops": ops}, entry["fmt"])
+        else:
+            body = entry["msg"]
+        self._send(entry, target, indexes, body, batched)
+
+    def _send(self, entry, target, indexes, body, batched):
+        token = PENDING_PREFIX + self.tag + uuid.uuid4().hex.encode()
+        self.pending[token] = (entry, indexes, time.time(), batched, target)
+        heapq.heappush(self.timeouts, (entry["expires"], token))
+        self.in_flight[target] = self.in_flight.get(target, 0) + 1
+        self.count(target, "sent")
+        entry["waiting"] += 1
+        self.backend.send_multipart([target, token, body])
+
+    def _forward(self, entry, i, delta):
+        """Merge the delta an item op made on its first replica into the others."""
+        merge = as_merge(entry["ops"][i].get("list_id"), delta)
+        for sid, hint in entry["followers"].pop(i):
+            op = dict(merge, hint=hint) if hint else merge
+            self._send(entry, sid, [i], encode({"op": "batch", "ops": [op]}, entry["fmt"]), True)
+
+    def _take_over(self, entry, i):
+        """An item op's coordinator made no delta (an error or a timeout): send the
+        op to the next follower, which coordinates in its place. Returns False if
+        none is left."""
+        followers = entry["followers"].get(i)
+        if not followers:
+            return False
+        sid, hint = followers.pop(0)
+        entry["expires"] = max(entry["expires"], time.time() + REQUEST_TIMEOUT)
+        self.metrics.inc("proxy.takeovers")
+        self._send_op(entry, sid, [i], {i: hint} if hint else None)
+        return True
+
+    def _done(self, target):
+        self.in_flight[target] -= 1
+
+    def route(self, client_id, req, ops, msg, fmt=JSON):
+        """Fan ops out to their replicas. A single request (msg given) is forwarded as is,
+        otherwise each server gets one sub-batch. Returns the servers contacted."""
+        entry = self._entry(client_id, req, ops, msg, fmt)
+        groups = {}
+        hints = {}
+        for i, o in enumerate(ops):
+            with self.metrics.timer("proxy.ring_lookup"):
+                replicas = self.replicas(o.get("list_id"))
+            if o.get("op") in BROADCAST_OPS:
+                entry["results"][i] = {"status": "error", "message": "Not allowed in a batch"}
+                entry["open"] -= 1
+                continue
+            if o.get("op") in SERVER_OPS:
+                entry["results"][i] = {"status": "error", "message": "Not allowed"}
+                entry["open"] -= 1
+                continue
+            if not replicas:
+                entry["results"][i] = {"status": "error", "message": "No servers available"}
+                entry["open"] -= 1
+                continue
+            if o.get("op") in READ_OPS:
+                # Least loaded first; the rest are tried in turn if a replica answers with an error.
+                targets = sorted((sid for sid, _ in replicas if not self.saturated(sid)), key=self.load)
+                entry["spare"][i] = targets[self.r:]
+                targets = targets[:self.r]
+            elif any(self.saturated(sid) for sid, _ in replicas):
+                targets = []
+            else:
+                entry["needed"][i] = min(self.w, len(replicas))
+                if o.get("op") in ITEM_OPS:
+                    entry["followers"][i] = replicas[1:]
+                    replicas = replicas[:1]
+                targets = []
+                for sid, hint in replicas:
+                    targets.append(sid)
+                    if hint:
+                        hints.setdefault(sid, {})[i] = hint
+            if not targets:
+                entry["results"][i] = dict(BUSY)
+                entry["open"] -= 1
+                self.metrics.inc("proxy.busy")
+                for sid, _ in replicas:
+                    if self.saturated(sid):
+                        self.count(sid, "busy")
+                continue
+            for target in targets:
+                groups.setdefault(target, []).append(i)
+
+        for target, indexes in groups.items():
+            self._send_op(entry, target, indexes, hints.get(target))
+
+        if entry["open"] == 0:
+            self.finish(entry)
+        return list(groups)
+
+    def load(self, sid):
+        return self.in_flight.get(sid, 0), self.latency.get(sid, 0)
+
+    def broadcast(self, client_id, req, msg, fmt=JSON):
+        """Send the request to every server; the client gets one result per server."""
+        entry = self._entry(client_id, req, list(self.servers), None, fmt)
+        entry["broadcast"] = True
+        for i, target in enumerate(self.servers):
+            if self.saturated(target):
+                entry["results"][i] = dict(BUSY)
+                entry["open"] -= 1
+                self.count(target, "busy")
+            else:
+                self._send(entry, target, [i], msg, False)
+        if entry["open"] == 0:
+            self.finish(entry)
+
+    def collect(self, server_id, token, msg):
+        item = self.pending.pop(token, None)
+        if item is None:
+            return
+        entry, indexes, sent, batched, target = item
+        self._done(target)
+        self.latency[server_id] = 0.8 * self.latency.get(server_id, 0) + 0.2 * (time.time() - sent)
+        entry["waiting"] -= 1
+        if entry["done"]:
+            return
+
+        if (entry["single"] and not batched and entry["needed"][0] == 1
+                and entry["ops"][0].get("op") not in ITEM_OPS and plain_ok(msg.bytes)):
+            # The first success answers the request and the proxy adds nothing to it:
+            # the server's frame goes back as it is.
+            entry["done"] = True
+            self.metrics.observe(f"proxy.latency.{entry['req'].get('op')}", time.time() - entry["received"])
+            self.frontend.send_multipart([entry["client"], msg])
+            return
+
+        with self.metrics.timer("proxy.decode"):
+            reply = decode(msg.bytes)
+        if batched:
+            results = reply.get("results") or [reply] * len(indexes)
+        else:
+            results = [reply]
+
+        for i, result in zip(indexes, results):
+            delta = result.pop("delta", None)
+            if delta is not None and entry["followers"].get(i):
+                self._forward(entry, i, delta)
+            if entry["results"][i] is not None:
+                continue
+            if result.get("status") in ANSWERED or entry.get("broadcast"):
+                entry["acks"][i] += 1
+                if entry["acks"][i] >= entry["needed"][i]:
+                    entry["results"][i] = result
+                    entry["open"] -= 1
+            else:
+                entry["errors"][i] = result
+                if entry["spare"].get(i):
+                    self._send_op(entry, entry["spare"][i].pop(0), [i])
+                elif delta is None:
+                    self._take_over(entry, i)
+
+        if entry["open"] == 0 or entry["waiting"] == 0:
+            self.finish(entry)
+
+    def finish(self, entry):
+        entry["done"] = True
+        results = [r or e or {"status": "timeout"} for r, e in zip(entry["results"], entry["errors"])]
+        reply = results[0] if entry["single"] else {"status": "ok", "results": results}
+        op = entry["req"].get("op")
+        if op == "metrics":
+            reply["proxy"] = self.metrics.snapshot()
+        elif op == "list_all_lists":
+            reply = merge_list_pages(results)
+        trace = reply.get("trace")
+        if trace is not None:
+            # Hops before and after the server's own stamps.
+            reply["trace"] = trace[:1] + [["proxy.recv", entry["received"]]] + trace[1:] + [["proxy.reply", time.time()]]
+        self.metrics.observe(f"proxy.latency.{op}", time.time() - entry["received"])
+        self.reply_to(entry["client"], entry["req"], reply, entry["fmt"])
+
+    def expire(self, now):
+        while self.timeouts and self.timeouts[0][0] < now:
+            _, token = heapq.heappop(self.timeouts)
+            # Tokens already answered are gone from both maps.
+            item = self.pending.pop(token, None)
+            if item is not None:
+                self._done(item[4])
+                self.count(item[4], "timeouts")
+                self.metrics.inc("proxy.timeouts")
+                entry = item[0]
+                # A timed-out coordinator may still have applied its op, but without
+                # its delta the write would reach no replica but that one.
+                taken = [i for i in item[1] if not entry["done"] and entry["results"][i] is None and self._take_over(entry, i)]
+                if not entry["done"] and not taken:
+                    self.finish(entry)
+            relay = self.relays.pop(token, None)
+            if relay is not None:
+                # Tell the sender, so it can retry later instead of waiting on an answer that never comes.
+                origin, req_id, fmt = relay
+                self.backend.send_multipart([origin, encode({"status": "timeout", "req_id": req_id}, fmt)])
+
+        for sid in self.detector.expired(now):
+            if self.servers.pop(sid, None) is None:
+                continue
+            self.down[sid] = now + DECOMMISSION_TIMEOUT
+            heapq.heappush(self.decommissions, (self.down[sid], sid))
+            self.latency.pop(sid, None)
+            self.announce(f"[-] {sid.decode()} is down (timeout)")
+
+        while self.decommissions and self.decommissions[0][0] < now:
+            due, sid = heapq.heappop(self.decommissions)
+            if self.down.get(sid) != due:
+                continue  # came back in the meantime
+            self.ring.remove_node(sid.decode())
+            self.identities.pop(sid.decode(), None)
+            self.formats.pop(sid, None)
+            # Its requests timed out long ago.
+            self.in_flight.pop(sid, None)
+            self.counters.pop(sid, None)
+            del self.down[sid]
+            self.announce(f"[-] Removed {sid.decode()} from hash ring.")
+            self.rebalance_at = now + REBALANCE_DELAY
+
+        if self.rebalance_at and now >= self.rebalance_at:
+            self.rebalance_at = None
+            nodes = [sid.decode() for sid in list(self.servers) + list(self.down)]
+            self.control("rebalance", {"nodes": nodes, "n": self.n})
+            self.announce(f"Rebalancing across {len(nodes)} nodes")
+
+
+def merge_list_pages(results):
+    """One list_all_lists page from every server's page after the same cursor.
+
+    Each server answered its first `limit` list ids after the cursor, so the
+    first `limit` ids of their union are the next page overall. A server page
+    that stops short holds exactly `limit` ids, which is how the limit is known."""
+    pages = [r for r in results if r.get("status") == "ok"]
+    if not pages:
+        return results[0] if results else {"status": "error", "message": "No servers available"}
+    lists = sorted(set().union(*(page["lists"] for page in pages)))
+    reply = {"status": "ok", "lists": lists}
+    limits = [len(page["lists"]) for page in pages if page.get("next")]
+    if limits:
+        reply["lists"] = lists[:min(limits)]
+        reply["next"] = reply["lists"][-1]
+    if len(pages) < len(results):
+        # Lists held only by the servers that did not answer are missing.
+        reply["incomplete"] = True
+    return reply
+
+
+def worker_id(index):
+    return f"w{index}".encode()
+
+
+class Acceptor:
+    """Owns a proxy's public ports and spreads the work over worker processes.
+
+    Client requests are fair-queued to the workers by zmq.proxy. Server replies
+    go back to the worker named in their pending token. Server pings and
+    relays reach every worker, so each worker keeps the same ring."""
+
+    def __init__(self, proxy_port_clients, proxy_port_servers, proxy_name, workers):
+        self.name = proxy_name
+        self.context = zmq.Context()
+        self.frontend = self.context.socket(zmq.ROUTER)
+        self.frontend.bind(f"tcp://*:{proxy_port_clients}")
+        self.clients = self.context.socket(zmq.DEALER)
+        self.clients_port = self.clients.bind_to_random_port("tcp://127.0.0.1")
+
+        self.backend = self.context.socket(zmq.ROUTER)
+        self.backend.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.backend.bind(f"tcp://*:{proxy_port_servers}")
+        self.workers = self.context.socket(zmq.ROUTER)
+        self.servers_port = self.workers.bind_to_random_port("tcp://127.0.0.1")
+        self.worker_ids = [worker_id(i) for i in range(workers)]
+
+        print(f"{proxy_name} started with {workers} workers.")
+        print(f"Clients: {proxy_port_clients}, Servers: {proxy_port_servers}")
+
+    def run(self):
+        threading.Thread(target=zmq.proxy, args=(self.frontend, self.clients), daemon=True).start()
+        poller = zmq.Poller()
+        poller.register(self.backend, zmq.POLLIN)
+        poller.register(self.workers, zmq.POLLIN)
+        tag_start = len(PENDING_PREFIX)
+        known = set(self.worker_ids)
+        while True:
+            try:
+                events = dict(poller.poll(1000))
+                if events.get(self.backend) == zmq.POLLIN:
+                    frames = self.backend.recv_multipart(copy=False)
+                    if len(frames) == 3:
+                        tag, sep, _ = frames[1].bytes[tag_start:].partition(b":")
+                        if sep and tag in known:
+                            self.workers.send_multipart([tag] + frames)
+                    else:
+                        for wid in self.worker_ids:
+                            self.workers.send_multipart([wid] + frames)
+
+                if events.get(self.workers) == zmq.POLLIN:
+                    self.backend.send_multipart(self.workers.recv_multipart(copy=False)[1:])
+
+            except KeyboardInterrupt:
+                print(f"\n{self.name} shutting down...")
+                break
+            except Exception as e:
+                print(f"Error in {self.name} acceptor: {e}")
+
+
+def run_worker(index, clients_port, servers_port, proxy_name, n, r, w, dump, high_water):
+    parent = os.getppid()
+
+    def watch_parent():
+        # Exit with the acceptor, however it ended.
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch_parent, daemon=True).start()
+    Proxy(clients_port, servers_port, proxy_name, n, r, w, dump, worker=index, high_water=high_water).run()
+
+
+def start_proxy(proxy_port_clients, proxy_port_servers, proxy_name,
+                n=REPLICAS_N, r=READ_R, w=WRITE_W, dump=None, workers=PROXY_WORKERS,
+                high_water=HIGH_WATER):
+    if workers <= 1:
+        Proxy(proxy_port_clients, proxy_port_servers, proxy_name, n, r, w, dump, high_water=high_water).run()
+        return
+    acceptor = Acceptor(proxy_port_clients, proxy_port_servers, proxy_name, workers)
+    # Spawned rather than forked, so workers do not inherit the public sockets.
+    spawn = multiprocessing.get_context("spawn")
+    for i in range(workers):
+        spawn.Process(target=run_worker, daemon=True,
+                      args=(i, acceptor.clients_port, acceptor.servers_port,
+                            proxy_name, n, r, w, dump, high_water)).start()
+    acceptor.run()
+
+
+PROXIES = [
+    {"proxy_name": "Proxy 1", "proxy_port_clients": 5558, "proxy_port_servers": 5559},
+    {"proxy_name": "Proxy 2", "proxy_port_clients": 5560, "proxy_port_servers": 5561},
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a proxy. Asks which one if no ports are given.")
+    parser.add_argument("choice", nargs="?", type=int, help="1 or 2: one of the standard local proxies")
+    parser.add_argument("--clients", type=int, help="client port")
+    parser.add_argument("--servers", type=int, help="server port")
+    parser.add_argument("--name")
+    parser.add_argument("--workers", type=int, default=PROXY_WORKERS)
+    parser.add_argument("-n", type=int, default=REPLICAS_N)
+    parser.add_argument("-r", type=int, default=READ_R)
+    parser.add_argument("-w", type=int, default=WRITE_W)
+    parser.add_argument("--high-water", type=int, default=HIGH_WATER)
+    parser.add_argument("--metrics", metavar="FILE", help=f"dump metrics to FILE every {DUMP_INTERVAL:g}s")
+    args = parser.parse_args()
+
+    if args.clients is not None and args.servers is not None:
+        p = {"proxy_name": args.name or f"Proxy {args.clients}",
+             "proxy_port_clients": args.clients, "proxy_port_servers": args.servers}
+    else:
+        choice = args.choice
+        if choice is None:
+            print("Choose which proxy to start:")
+            for i, p in enumerate(PROXIES):
+                print(f"{i+1}. {p['proxy_name']} ({p['proxy_port_clients']} / {p['proxy_port_servers']})")
+            try:
+                choice = int(input("Enter 1 or 2: "))
+            except ValueError:
+                choice = None
+        if choice not in [1, 2]:
+            print("Invalid choice.")
+            return
+        p = PROXIES[choice - 1]
+    start_proxy(p["proxy_port_clients"], p["proxy_port_servers"], p["proxy_name"],
+                args.n, args.r, args.w, args.metrics, args.workers, args.high_water)
 
 
 if __name__ == "__main__":
-    proxies = [
-        {"proxy_name": "Proxy 1", "proxy_port_clients": 5558, "proxy_port_servers": 5559},
-        {"proxy_name": "Proxy 2", "proxy_port_clients": 5560, "proxy_port_servers": 5561},
-    ]
-
-    print("Choose which proxy to start:")
-    for i, p in enumerate(proxies):
-        print(f"{i+1}. {p['proxy_name']} ({p['proxy_port_clients']} / {p['proxy_port_servers']})")
-
-    try:
-        choice = int(input("Enter 1 or 2: "))
-        if choice in [1, 2]:
-            p = proxies[choice - 1]
-            start_proxy(p["proxy_port_clients"], p["proxy_port_servers"], p["proxy_name"])
-    except ValueError:
-        print("Invalid choice.")
+    main()
@@ -0,0 +1,158 @@
+import json
+import time
+import uuid
+import snapshot
+from hashring import HashRing
+from protocol import encode, JSON
+
+# Background data movement between servers, relayed through the proxy.
+#
+# The handoff table holds two kinds of rows for a target node:
+#   - request IS NULL: a rebalance transfer. Transfers due for one node go out
+#     together as a snapshot (see snapshot.py) of the lists' current CRDT
+#     state, so they are always fresh; the rows remember which snapshot
+#     carried them.
+#   - request set: a hinted write accepted on behalf of a node that was down.
+# Rows are deleted once the target acks them. Rows for a node the proxy says is
+# unreachable are parked until the proxy announces the node is back.
+
+HANDOFF_CHUNK = 50      # hinted writes sent per pump
+SNAPSHOT_ITEMS = 20000  # items per snapshot; a larger list goes alone
+HANDOFF_INTERVAL = 0.05  # seconds between pumps while work remains
+HANDOFF_RETRY = 10.0     # resend rows not acked after this long
+PARKED = 1e18
+
+
+def init_handoff(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS handoff (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    node TEXT,
+                    list_id TEXT,
+                    request TEXT,
+                    sent_at REAL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS handoff_node ON handoff(node)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS handoff_transfer ON handoff(node, list_id) WHERE request IS NULL")
+
+
+def _ring(nodes):
+    ring = HashRing()
+    ring.add_nodes(nodes)
+    return ring
+
+
+def plan_rebalance(c, me, nodes, n):
+    """Queue transfers of every local list to the owners it gained in the new membership."""
+    c.execute("SELECT value FROM meta WHERE key='ring_nodes'")
+    row = c.fetchone()
+    saved = json.loads(row[0]) if row else None
+    # A membership saved under another ring hash says nothing about current placement.
+    old = _ring(saved["nodes"]) if isinstance(saved, dict) and saved.get("hash") == HashRing.HASH else None
+    c.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('ring_nodes', ?)",
+              (json.dumps({"hash": HashRing.HASH, "nodes": sorted(nodes)}),))
+    new = _ring(nodes)
+
+    queued = 0
+    c.execute("SELECT id FROM shopping_lists")
+    for (list_id,) in c.fetchall():
+        before = old.get_nodes(list_id, n) if old else []
+        # One surviving previous owner does the sending.
+        senders = [node for node in before if node in nodes]
+        if senders and senders[0] != me:
+            continue
+        for owner in new.get_nodes(list_id, n):
+            if owner != me and owner not in before:
+                c.execute("INSERT OR IGNORE INTO handoff(node, list_id) VALUES (?, ?)", (owner, list_id))
+                queued += 1
+
+    # Nodes that left the ring get their lists through the transfers above.
+    if nodes:
+        marks = ",".join("?" * len(nodes))
+        c.execute(f"DELETE FROM handoff WHERE node NOT IN ({marks})", list(nodes))
+    return queued
+
+
+def store_hint(c, node, op):
+    c.execute("INSERT INTO handoff(node, list_id, request, sent_at) VALUES (?, ?, ?, ?)",
+              (node, op.get("list_id"), json.dumps(op), PARKED))
+
+
+def release(c, node):
+    """The node is reachable again: send everything queued for it."""
+    c.execute("UPDATE handoff SET sent_at=NULL WHERE node=?", (node,))
+
+
+def pump(conn, send, limit=HANDOFF_CHUNK, fmt=JSON):
+    """Send one snapshot and up to limit hinted writes, each as one encoded relay
+    message passed to send. Returns True if more are waiting."""
+    c = conn.cursor()
+    now = time.time()
+    more = send_snapshot(c, send, now, fmt)
+    c.execute("""SELECT id, node, request FROM handoff
+                 WHERE request IS NOT NULL AND (sent_at IS NULL OR sent_at < ?)
+                 ORDER BY id LIMIT ?""", (now - HANDOFF_RETRY, limit))
+    rows = c.fetchall()
+    for row_id, node, request in rows:
+        request = json.loads(request)
+        request["req_id"] = f"handoff-{row_id}"
+        send(encode({"op": "relay", "target": node, "request": request}, fmt))
+        c.execute("UPDATE handoff SET sent_at=? WHERE id=?", (now, row_id))
+    conn.commit()
+    return more or len(rows) == limit
+
+
+def send_snapshot(c, send, now, fmt=JSON):
+    """Send the due transfers of one node as a snapshot. Returns True if more are due."""
+    c.execute("""SELECT node FROM handoff WHERE request IS NULL AND (sent_at IS NULL OR sent_at < ?)
+                 ORDER BY id LIMIT 1""", (now - HANDOFF_RETRY,))
+    row = c.fetchone()
+    if row is None:
+        return False
+    node = row[0]
+    c.execute("""SELECT id, list_id, (SELECT COUNT(*) FROM item_state WHERE item_state.list_id = handoff.list_id)
+                 FROM handoff WHERE node=? AND request IS NULL AND (sent_at IS NULL OR sent_at < ?)
+                 ORDER BY id""", (node, now - HANDOFF_RETRY))
+    rows, items = [], 0
+    for row_id, list_id, count in c:
+        if rows and items + count > SNAPSHOT_ITEMS:
+            break
+        rows.append((row_id, list_id))
+        items += count
+    snapshot_id = uuid.uuid4().hex
+    chunks = snapshot.export(c, [list_id for _, list_id in rows], snapshot_id)
+    for chunk in chunks:
+        request = {"op": "snapshot", "payload": chunk, "req_id": f"snapshot-{snapshot_id}-{chunk['seq']}"}
+        send(encode({"op": "relay", "target": node, "request": request}, fmt))
+    c.executemany("UPDATE handoff SET sent_at=?, snapshot=? WHERE id=?", [(now, snapshot_id, row_id) for row_id, _ in rows])
+    print(f"Snapshot {snapshot_id[:8]}: {len(rows)} lists, {items} items in {len(chunks)} chunks to {node}")
+    return True
+
+
+def acknowledge(conn, reply):
+    """Handle the relayed reply to a handoff row or a snapshot chunk."""
+    req_id = str(reply.get("req_id", ""))
+    if req_id.startswith("snapshot-"):
+        _, snapshot_id, _ = req_id.split("-")
+        if reply.get("status") == "ok":
+            if "imported" in reply:
+                conn.execute("DELETE FROM handoff WHERE snapshot=?", (snapshot_id,))
+        elif reply.get("message") == "Target not available":
+            conn.execute("UPDATE handoff SET sent_at=?, snapshot=NULL WHERE snapshot=?", (PARKED, snapshot_id))
+        elif reply.get("status") == "timeout":
+            # The import may still finish, and its ack then clears the rows; resend only after HANDOFF_RETRY.
+            conn.execute("UPDATE handoff SET sent_at=? WHERE snapshot=?", (time.time(), snapshot_id))
+        else:
+            # Damaged or incomplete: send a fresh snapshot on the next pump.
+            print(f"Snapshot {snapshot_id[:8]} rejected: {reply.get('message')}")
+            conn.execute("UPDATE handoff SET sent_at=NULL, snapshot=NULL WHERE snapshot=?", (snapshot_id,))
+        conn.commit()
+        return
+    if not req_id.startswith("handoff-"):
+        return
+    row_id = int(req_id[len("handoff-"):])
+    if reply.get("status") == "ok":
+        conn.execute("DELETE FROM handoff WHERE id=?", (row_id,))
+    elif reply.get("status") == "timeout":
+        conn.execute("UPDATE handoff SET sent_at=? WHERE id=?", (time.time(), row_id))
+    else:
+        conn.execute("UPDATE handoff SET sent_at=? WHERE id=?", (PARKED, row_id))
+    conn.commit()
@@ -0,0 +1,29 @@
+# Versioned schema migrations, tracked in SQLite's user_version.
+#
+# A store is at version k once the first k steps have run. Each step commits
+# together with its version bump, so an interrupted upgrade resumes at the
+# step that failed. Steps must be written against the schema they find, never
+# against the current code.
+
+
+def version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, steps):
+    """Run the steps the database has not seen yet. Returns the version it started at."""
+    start = version(conn)
+    if start > len(steps):
+        raise Exception(f"Database schema v{start} is newer than this code (v{len(steps)}).")
+    for number, step in enumerate(steps[start:], start + 1):
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            step(c)
+            c.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Schema upgraded to v{number}: {step.__doc__.splitlines()[0]}")
+    return start
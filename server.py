@@ -1,12 +1,71 @@
 import zmq
 import json
+import argparse
 import uuid
 import sqlite3
 import time
+import queue
+import threading
+from collections import OrderedDict
+import crdt
+import rebalance
+import snapshot
+import schema
+from heartbeat import HEARTBEAT_INTERVAL
+from metrics import REGISTRY as metrics, DUMP_INTERVAL, stamp
+from protocol import encode, decode, format_of, with_req_id, as_merge, from_proxy, SERVER_OPS, FORMATS, JSON
 
-def init_db(db_file):
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
+# Concurrency: the socket thread only moves messages. Reads run on a pool of
+# threads with a connection each; writes go to a single writer thread that
+# applies everything arriving within GROUP_COMMIT_WINDOW in one transaction.
+# WAL lets the readers run while the writer commits. Handoffs to other servers
+# (see rebalance.py) run on a thread of their own, as does recording their acks.
+READ_WORKERS = 4
+GROUP_COMMIT_WINDOW = 0.001
+GROUP_COMMIT_MAX = 256
+READ_OPS = {"ping", "get_info", "list_all_lists", "changes_since"}
+
+# How hard a commit is pushed to disk (PRAGMA synchronous under WAL):
+#   "full"   - the WAL is synced on every commit; nothing acknowledged is lost.
+#   "normal" - synced at checkpoints; a power cut may drop the last commits.
+#   "off"    - left to the OS; fastest, a crash of the machine may lose more.
+DURABILITY = "normal"
+SYNC_LEVELS = {"full": "FULL", "normal": "NORMAL", "off": "OFF"}
+
+# Replies to get_info, list_all_lists and changes_since are paged. A page
+# that stops short says where to continue: "next" (a cursor to pass back as
+# "after") or, for changes_since, "more" (continue from the returned version).
+PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+# Serialized get_info replies kept in memory, bounded by total size.
+CACHE_BYTES = 64 * 1024 * 1024
+
+# First pages of get_info carry the list's version, a digest of all its items
+# kept up to date on every write (see crdt.row_digest), so replicas holding
+# the same items agree on it. A request whose "if_version"
+# is still current is answered "not_modified" without the items. The lease is
+# how long a client may answer reads from its copy before asking again;
+# nothing is called back, so it only bounds how stale that copy can get.
+LIST_LEASE = 5.0
+
+def connect(db_file, durability=DURABILITY):
+    conn = sqlite3.connect(db_file, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SYNC_LEVELS[durability]}")
+    return conn
+
+def init_db(db_file, durability=DURABILITY):
+    conn = connect(db_file, durability)
+    schema.migrate(conn, MIGRATIONS)
+    return conn
+
+def _schema_v1(c):
+    """Baseline tables, change log and CRDT state.
+
+    Stores created before versioning already have some of these; every
+    statement here tolerates that.
+    """
     c.execute('''CREATE TABLE IF NOT EXISTS shopping_lists (id TEXT PRIMARY KEY)''')
     c.execute('''CREATE TABLE IF NOT EXISTS items (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -16,121 +75,608 @@ def init_db(db_file):
                     target_qtd INTEGER,
                     acquired_flag INTEGER,
                     FOREIGN KEY(list_id) REFERENCES shopping_lists(id))''')
-    conn.commit()
-    return conn
+    c.execute('''CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)''')
+    c.execute("INSERT OR IGNORE INTO meta(key, value) VALUES ('node_id', ?)", (str(uuid.uuid4()),))
+
+    # Change log: one row per list ('' name) or item, re-stamped with a fresh
+    # version on every write, so it never holds more rows than keys ever written.
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='changes'")
+    new_log = c.fetchone() is None
+    c.execute('''CREATE TABLE IF NOT EXISTS changes (
+                    version INTEGER PRIMARY KEY AUTOINCREMENT,
+                    list_id TEXT,
+                    name TEXT)''')
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS changes_key ON changes(list_id, name)")
+    if new_log:
+        c.execute("INSERT OR IGNORE INTO changes(list_id, name) SELECT id, '' FROM shopping_lists")
+        c.execute("INSERT OR IGNORE INTO changes(list_id, name) SELECT list_id, name FROM items")
+
+    # CRDT state per item (see crdt.py); the items table is its materialized view.
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='item_state'")
+    new_state = c.fetchone() is None
+    c.execute('''CREATE TABLE IF NOT EXISTS item_state (
+                    list_id TEXT,
+                    name TEXT,
+                    state TEXT,
+                    PRIMARY KEY(list_id, name))''')
+    if new_state:
+        node_id = get_node_id(c)
+        c.execute("SELECT list_id, name, current_qtd, target_qtd FROM items ORDER BY id")
+        for list_id, name, current, target in c.fetchall():
+            item = crdt.new_item()
+            crdt.merge_into(c, list_id, name, crdt.add_delta(item, node_id, crdt.next_dot(c, node_id), current, target))
+
+    rebalance.init_handoff(c)
+
+def _schema_v2(c):
+    """One row per item, keyed by (list_id, name).
+
+    Older stores may hold duplicates from repeated create_item calls; the
+    newest row of each is the one reads used to see last.
+    """
+    c.execute("DELETE FROM items WHERE id NOT IN (SELECT MAX(id) FROM items GROUP BY list_id, name)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS items_key ON items(list_id, name)")
+    c.execute("CREATE INDEX IF NOT EXISTS handoff_due ON handoff(sent_at)")
+
+def _schema_v3(c):
+    """Snapshot transfers: handoff rows remember their snapshot, and incoming chunks are staged."""
+    c.execute("ALTER TABLE handoff ADD COLUMN snapshot TEXT")
+    c.execute("CREATE INDEX handoff_snapshot ON handoff(snapshot)")
+    snapshot.init_staging(c)
+
+def _schema_v4(c):
+    """Lists store their version, updated as their items change."""
+    c.execute("ALTER TABLE shopping_lists ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    versions = {}
+    c.execute("SELECT list_id, name, current_qtd, target_qtd, acquired_flag FROM items")
+    for list_id, name, current, target, acquired in c.fetchall():
+        versions[list_id] = versions.get(list_id, 0) ^ crdt.row_digest(name, current, target, acquired)
+    c.executemany("UPDATE shopping_lists SET version=? WHERE id=?", [(v, list_id) for list_id, v in versions.items()])
+
+MIGRATIONS = [_schema_v1, _schema_v2, _schema_v3, _schema_v4]
+
+def get_node_id(db):
+    """Persistent id of this server's store; also used as its identity on the ring."""
+    return db.execute("SELECT value FROM meta WHERE key='node_id'").fetchone()[0]
+
+def node_name(db):
+    return f"server-{get_node_id(db)}"
+
+def record_change(c, list_id, name=""):
+    c.execute("INSERT OR REPLACE INTO changes(list_id, name) VALUES (?, ?)", (list_id, name))
+
+def ensure_list(c, list_id):
+    c.execute("INSERT OR IGNORE INTO shopping_lists(id) VALUES (?)", (list_id,))
+    if c.rowcount:
+        record_change(c, list_id)
+
+def apply_delta(c, list_id, name, delta):
+    """Merge an item delta, refresh its materialized row and log the change.
+    Only a delta that adds the item creates its list."""
+    if delta.get("adds"):
+        ensure_list(c, list_id)
+    state, changed = crdt.merge_into(c, list_id, name, delta)
+    if not changed:
+        return
+    c.execute("SELECT current_qtd, target_qtd, acquired_flag FROM items WHERE list_id=? AND name=?", (list_id, name))
+    old = c.fetchone()
+    change = crdt.row_digest(name, *old) if old else 0
+    if crdt.is_present(state):
+        current, target = crdt.values(state)
+        c.execute("""INSERT INTO items(list_id, name, current_qtd, target_qtd, acquired_flag)
+                     VALUES (?,?,?,?,0)
+                     ON CONFLICT(list_id, name) DO UPDATE
+                     SET current_qtd=excluded.current_qtd, target_qtd=excluded.target_qtd""",
+                  (list_id, name, current, target))
+        change ^= crdt.row_digest(name, current, target, old[2] if old else 0)
+    else:
+        c.execute("DELETE FROM items WHERE list_id=? AND name=?", (list_id, name))
+    crdt.bump_version(c, list_id, change)
+    record_change(c, list_id, name)
 
 def handle_request(conn, req):
+    """Apply one request in its own transaction."""
+    try:
+        reply = apply_request(conn.cursor(), req)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return reply
+
+def apply_request(c, req):
+    """Run a request on the cursor. The caller owns the transaction."""
+    if req.get("op") == "batch":
+        return apply_batch(c, req.get("ops", []))
+    return apply_op(c, req.get("op"), req.get("list_id"), req.get("payload", {}))
+
+def names_server_op(req):
+    """True if the request, or an op in its batch, is one only a proxy may send."""
+    ops = req.get("ops") or [] if req.get("op") == "batch" else [req]
+    return any(o.get("op") in SERVER_OPS for o in ops)
+
+def apply_batch(c, ops):
+    """Apply a group of ops, returning per-op results in order."""
+    results = []
+    for o in ops:
+        try:
+            result = apply_op(c, o.get("op"), o.get("list_id"), o.get("payload") or {})
+            # Written on behalf of a replica that is down: keep a copy to hand back later.
+            # A plain item op is kept as the delta it made, so the replay merges the same state.
+            if o.get("hint") and result.get("status") == "ok":
+                hinted = as_merge(o.get("list_id"), result["delta"]) if "delta" in result else o
+                rebalance.store_hint(c, o["hint"], {k: v for k, v in hinted.items() if k != "hint"})
+            results.append(result)
+        except (KeyError, TypeError) as e:
+            results.append({"status": "error", "message": f"Bad request: {e}"})
+    return {"status": "ok", "results": results}
+
+class ListCache:
+    """LRU of serialized get_info replies, answered without touching SQLite.
+
+    Entries are keyed by (list_id, format), one per wire format in use, and
+    hold the reply with the list's version.
+
+    The writer refreshes the cached lists it changed before acknowledging the
+    writes. Readers fill misses, but a fill is dropped if a write to the list
+    landed while it was being read, so a stale reply is never cached.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.filling = {}
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def begin_fill(self, list_id):
+        token = object()
+        with self.lock:
+            self.filling[list_id] = token
+        return token
+
+    def fill(self, key, entry, token):
+        with self.lock:
+            if self.filling.get(key[0]) is token:
+                del self.filling[key[0]]
+                self._store(key, entry)
+
+    def write_through(self, list_ids, build):
+        """After a commit: rebuild cached lists among list_ids, cancel fills of the rest."""
+        with self.lock:
+            cached = [(list_id, fmt) for list_id in list_ids for fmt in FORMATS if (list_id, fmt) in self.entries]
+            for list_id in list_ids:
+                self.filling.pop(list_id, None)
+        for key in cached:
+            entry = build(*key)
+            with self.lock:
+                if entry is None:
+                    self._drop(key)
+                else:
+                    self._store(key, entry)
+
+    def _store(self, key, entry):
+        self._drop(key)
+        self.entries[key] = entry
+        self.size += len(entry[0])
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, (old, _) = self.entries.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                    "lists": len(self.entries), "bytes": self.size}
+
+def page_limit(payload):
+    return max(1, min(int(payload.get("limit") or PAGE_SIZE), MAX_PAGE_SIZE))
+
+def is_first_page(req):
+    """Only default first pages of get_info are cached."""
+    payload = req.get("payload") or {}
+    return req.get("op") == "get_info" and not payload.get("after") and not payload.get("limit")
+
+def list_reply(c, list_id, fmt=JSON):
+    """(serialized get_info reply, version) for a list, or None if it does not exist."""
+    reply = apply_op(c, "get_info", list_id, {})
+    return (encode(reply, fmt), reply["version"]) if reply["status"] == "ok" else None
+
+def not_modified(version):
+    return {"status": "not_modified", "version": version, "lease": LIST_LEASE}
+
+def written_lists(req):
+    ops = req.get("ops", []) if req.get("op") == "batch" else [req]
+    return {o.get("list_id") for o in ops if o.get("list_id") is not None}
+
+def is_read(req):
+    if req.get("op") == "batch":
+        return all(o.get("op") in READ_OPS for o in req.get("ops", []))
+    return req.get("op") in READ_OPS
+
+def commit_group(conn, group):
+    """Apply queued write requests in one transaction. Returns (client_id, req, fmt, reply) for each.
+
+    Each request runs in a savepoint, so one that fails is rolled back alone."""
     c = conn.cursor()
-    op = req.get("op")
-    list_id = req.get("list_id")
-    payload = req.get("payload", {})
+    done = []
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        for client_id, req, fmt in group:
+            stamp(req, "server.start")
+            c.execute("SAVEPOINT request")
+            try:
+                reply = apply_request(c, req)
+            except Exception as e:
+                c.execute("ROLLBACK TO request")
+                reply = {"status": "error", "message": f"Bad request: {e}"}
+            c.execute("RELEASE request")
+            done.append((client_id, req, fmt, reply))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Group commit failed: {e}")
+        done = [(client_id, req, fmt, {"status": "error", "message": str(e)}) for client_id, req, fmt in group]
+    return done
+
+def send_reply(out, route, req, reply, fmt):
+    """route is the frames the reply is addressed with: the proxy it came through, then the requester."""
+    if "req_id" in req:
+        reply["req_id"] = req["req_id"]
+    if "trace" in req:
+        reply["trace"] = req["trace"] + [["server.done", time.time()]]
+    with metrics.timer("server.encode"):
+        body = encode(reply, fmt)
+    out.send_multipart(route + [body])
+
+def send_cached(out, route, req, entry, fmt):
+    """Send a serialized get_info reply; only a traced request needs it re-encoded."""
+    body, version = entry
+    if (req.get("payload") or {}).get("if_version") == version:
+        send_reply(out, route, req, not_modified(version), fmt)
+    elif "trace" in req:
+        send_reply(out, route, req, decode(body), fmt)
+    else:
+        out.send_multipart(route + [with_req_id(body, req.get("req_id"))])
 
+def write_worker(context, db_file, jobs, durability, cache):
+    conn = connect(db_file, durability)
+    out = context.socket(zmq.PUSH)
+    out.connect("inproc://replies")
+    while True:
+        jobs_taken = [jobs.get()]
+        deadline = time.time() + GROUP_COMMIT_WINDOW
+        while len(jobs_taken) < GROUP_COMMIT_MAX:
+            try:
+                jobs_taken.append(jobs.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        now = time.perf_counter()
+        group = []
+        for route, req, fmt, queued in jobs_taken:
+            metrics.observe("server.queue_wait.write", now - queued)
+            group.append((route, req, fmt))
+        metrics.observe("server.group_size", len(group))
+        with metrics.timer("server.sqlite.commit_group"):
+            done = commit_group(conn, group)
+        # Replies go out only once the group is committed and the cache reflects it.
+        written = set().union(*(written_lists(req) for _, req, _ in group))
+        for _, _, _, reply in done:
+            written.update(reply.pop("written", ()))  # lists a snapshot import touched
+        cache.write_through(written, lambda list_id, fmt: list_reply(conn.cursor(), list_id, fmt))
+        for route, req, fmt, reply in done:
+            send_reply(out, route, req, reply, fmt)
+
+def read_worker(context, db_file, jobs, cache):
+    conn = connect(db_file)
+    out = context.socket(zmq.PUSH)
+    out.connect("inproc://replies")
+    while True:
+        route, req, fmt, queued = jobs.get()
+        metrics.observe("server.queue_wait.read", time.perf_counter() - queued)
+        stamp(req, "server.start")
+        try:
+            if is_first_page(req):
+                list_id = req.get("list_id")
+                token = cache.begin_fill(list_id)
+                with metrics.timer("server.sqlite.get_info"):
+                    entry = list_reply(conn.cursor(), list_id, fmt)
+                if entry is not None:
+                    cache.fill((list_id, fmt), entry, token)
+                    send_cached(out, route, req, entry, fmt)
+                    continue
+            with metrics.timer(f"server.sqlite.{req.get('op')}"):
+                reply = handle_request(conn, req)
+        except Exception as e:
+            reply = {"status": "error", "message": f"Bad request: {e}"}
+        send_reply(out, route, req, reply, fmt)
+
+def pump_worker(context, db_file, durability, upstreams, acks):
+    """Send due snapshots and hinted writes through the proxy that answered last,
+    and record the acks the socket thread queues for them."""
+    conn = connect(db_file, durability)
+    out = context.socket(zmq.PUSH)
+    out.connect("inproc://replies")
+    next_pump = 0
+    while True:
+        try:
+            try:
+                rebalance.acknowledge(conn, acks.get(timeout=max(0, next_pump - time.time())))
+                continue
+            except queue.Empty:
+                pass
+            relay = upstreams.relay()
+            busy = False
+            if relay is not None:
+                origin, fmt = bytes([relay[0]]), relay[1]
+                busy = rebalance.pump(conn, lambda body: out.send_multipart([origin, body]), fmt=fmt)
+            next_pump = time.time() + (rebalance.HANDOFF_INTERVAL if busy else 1)
+        except Exception as e:
+            conn.rollback()
+            print(f"Handoff failed: {e}")
+            next_pump = time.time() + 1
+
+def apply_op(c, op, list_id, payload):
+    """Run a single op on the cursor. The caller owns the transaction."""
     if op == "ping":
         return {"status": "pong"}
 
     elif op == "create_list":
         try:
             c.execute("INSERT INTO shopping_lists(id) VALUES (?)", (list_id,))
-            conn.commit()
+            record_change(c, list_id)
             return {"status": "ok"}
         except sqlite3.IntegrityError:
             return {"status": "error", "message": "List already exists"}
 
-    elif op == "create_item":
-        c.execute("""INSERT INTO items(list_id, name, current_qtd, target_qtd, acquired_flag)
-                     VALUES (?,?,?,?,0)""",
-                  (list_id, payload["item_name"], payload["current"], payload["total"]))
-        conn.commit()
+    elif op == "merge":
+        # A merge with no items is how a list is created; item deltas create it as they need to.
+        if not payload["items"]:
+            ensure_list(c, list_id)
+        for name, delta in payload["items"].items():
+            apply_delta(c, list_id, name, delta)
         return {"status": "ok"}
 
+    # Plain item ops are applied as deltas from this server's own replica. The
+    # delta is part of the reply, so the proxy can merge it into the other replicas.
+    elif op == "create_item":
+        node_id = get_node_id(c)
+        item = crdt.load_item(c, list_id, payload["item_name"])
+        delta = crdt.add_delta(item, node_id, crdt.next_dot(c, node_id), payload["current"], payload["total"])
+        apply_delta(c, list_id, payload["item_name"], delta)
+        return {"status": "ok", "delta": {payload["item_name"]: delta}}
+
     elif op == "update_item":
-        c.execute("""UPDATE items SET current_qtd=?, target_qtd=?
-                     WHERE list_id=? AND name=?""",
-                  (payload["current"], payload["total"], list_id, payload["item_name"]))
-        conn.commit()
-        return {"status": "ok"}
+        item = crdt.load_item(c, list_id, payload["item_name"])
+        if not crdt.is_present(item):
+            return {"status": "error", "message": "Item not found"}
+        delta = crdt.set_delta(item, get_node_id(c), payload["current"], payload["total"])
+        apply_delta(c, list_id, payload["item_name"], delta)
+        return {"status": "ok", "delta": {payload["item_name"]: delta}}
 
     elif op == "delete_item":
-        c.execute("DELETE FROM items WHERE list_id=? AND name=?", (list_id, payload["item_name"]))
-        conn.commit()
-        return {"status": "ok"}
+        item = crdt.load_item(c, list_id, payload["item_name"])
+        if not crdt.is_present(item):
+            return {"status": "error", "message": "Item not found"}
+        delta = crdt.remove_delta(item)
+        apply_delta(c, list_id, payload["item_name"], delta)
+        return {"status": "ok", "delta": {payload["item_name"]: delta}}
 
     elif op == "get_info":
-        c.execute("SELECT id FROM shopping_lists WHERE id=?", (list_id,))
+        c.execute("SELECT version FROM shopping_lists WHERE id=?", (list_id,))
         row = c.fetchone()
         if not row:
             return {"status": "error", "message": "List not found"}
-        c.execute("SELECT name, current_qtd, target_qtd, acquired_flag FROM items WHERE list_id=?", (list_id,))
-        items = [{"name": r[0], "current_qtd": r[1], "target_qtd": r[2], "acquired_flag": bool(r[3])} for r in c.fetchall()]
-        return {"status": "ok", "list": {"id": list_id, "items": items}}
+        first = payload.get("after") is None
+        version = f"{row[0]:014x}"
+        if first and payload.get("if_version") == version:
+            return not_modified(version)
+        # Keyset paging over items_key: each page is an index seek, however deep.
+        limit = page_limit(payload)
+        query = "SELECT name, current_qtd, target_qtd, acquired_flag FROM items WHERE list_id=?"
+        args = [list_id]
+        if payload.get("after") is not None:
+            query += " AND name > ?"
+            args.append(payload["after"])
+        c.execute(query + " ORDER BY name LIMIT ?", args + [limit + 1])
+        rows = c.fetchall()
+        items = [{"name": r[0], "current_qtd": r[1], "target_qtd": r[2], "acquired_flag": bool(r[3])} for r in rows[:limit]]
+        reply = {"status": "ok", "list": {"id": list_id, "items": items}}
+        if len(rows) > limit:
+            reply["next"] = items[-1]["name"]
+        if first:
+            reply["version"] = version
+            reply["lease"] = LIST_LEASE
+        return reply
 
     elif op == "list_all_lists":
-        c.execute("SELECT id FROM shopping_lists")
+        limit = page_limit(payload)
+        c.execute("SELECT id FROM shopping_lists WHERE id > ? ORDER BY id LIMIT ?",
+                  (payload.get("after") or "", limit + 1))
         lists = [r[0] for r in c.fetchall()]
-        return {"status": "ok", "lists": lists}
+        reply = {"status": "ok", "lists": lists[:limit]}
+        if len(lists) > limit:
+            reply["next"] = lists[limit - 1]
+        return reply
+
+    elif op == "changes_since":
+        return changes_since(c, payload.get("versions", {}), page_limit(payload))
+
+    elif op == "snapshot":
+        return snapshot.receive(c, payload, apply_delta)
+
+    elif op == "rebalance":
+        queued = rebalance.plan_rebalance(c, node_name(c), payload["nodes"], payload["n"])
+        if queued:
+            print(f"Rebalance: {queued} list transfers queued")
+        return {"status": "ok", "queued": queued}
+
+    elif op == "handoff":
+        rebalance.release(c, payload["node"])
+        return {"status": "ok"}
 
     else:
         return {"status": "error", "message": "Unknown operation"}
 
-def connect_to_proxy(context, proxies, timeout=2.0):
-    for p in proxies:
-        try:
-            sock_front = context.socket(zmq.DEALER)
-            sock_front.setsockopt_string(zmq.IDENTITY, f"server-ping-{uuid.uuid4()}")
-            sock_front.connect(p["frontend"])
-            poller = zmq.Poller()
-            poller.register(sock_front, zmq.POLLIN)
-
-            sock_front.send_json({"op": "ping"})
-            socks = dict(poller.poll(timeout * 1000))
-            if socks.get(sock_front) == zmq.POLLIN:
-                reply = sock_front.recv_json()
-                if reply.get("status") == "pong":
-                    print(f"Proxy {p['frontend']} alive -> connecting to backend {p['backend']}")
-                    sock_front.close()
-                    sock_backend = context.socket(zmq.DEALER)
-                    sock_backend.setsockopt_string(zmq.IDENTITY, f"server-{uuid.uuid4()}")
-                    sock_backend.connect(p["backend"])
-                    return sock_backend
-            sock_front.close()
-        except Exception as e:
-            print(f"Failed to ping {p['frontend']}: {e}")
-    return None
+def changes_since(c, versions, limit=PAGE_SIZE):
+    """Up to limit changes written after the caller's watermark for this node.
 
-def main():
-    server_number = int(input("Server number (1-5): "))
-    db_file = f"server{server_number}.db"
+    Items are returned as CRDT states for the caller to merge; removed items
+    carry their remove dots. The returned version is the caller's next
+    watermark; "more" says whether changes remain past it. A key re-written
+    while the caller pages gets a newer version, so it shows up on a later page.
+    """
+    node_id = get_node_id(c)
+    since = versions.get(node_id, 0)
+
+    c.execute("""SELECT ch.version, ch.list_id, ch.name, s.state
+                 FROM changes ch LEFT JOIN item_state s ON s.list_id = ch.list_id AND s.name = ch.name
+                 WHERE ch.version > ?
+                 ORDER BY ch.version LIMIT ?""", (since, limit + 1))
+    rows = c.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    lists, items = [], []
+    for _, list_id, name, state in rows:
+        if name == "":
+            lists.append(list_id)
+        elif state is not None:
+            items.append({"list_id": list_id, "name": name, "state": json.loads(state)})
+    version = rows[-1][0] if rows else since
+    return {"status": "ok", "node": node_id, "version": version, "more": more, "lists": lists, "items": items}
+
+class Upstreams:
+    """This server's connections to every proxy.
+
+    Every proxy gets the pings, so all of them see the same servers and build
+    the same ring. Requests are answered through the proxy they came from,
+    named by the first frame of a reply's route."""
 
-    conn = init_db(db_file)
+    def __init__(self, context, backends, identity):
+        self.backends = backends
+        self.socks = []
+        for addr in backends:
+            sock = context.socket(zmq.DEALER)
+            sock.setsockopt_string(zmq.IDENTITY, identity)
+            sock.connect(addr)
+            self.socks.append(sock)
+        self.wire = [JSON] * len(backends)  # format for our own messages, settled by each pong
+        self.last_pong = [0.0] * len(backends)
+
+    def send_multipart(self, frames):
+        self.socks[frames[0][0]].send_multipart(frames[1:])
+
+    def ping(self):
+        for sock, wire in zip(self.socks, self.wire):
+            sock.send(encode({"op": "ping", "formats": FORMATS, "interval": HEARTBEAT_INTERVAL}, wire))
+
+    def pong(self, i, reply):
+        if not self.last_pong[i]:
+            print(f"Proxy {self.backends[i]} answered.")
+        self.wire[i] = reply.get("format", JSON)
+        self.last_pong[i] = time.time()
+
+    def relay(self):
+        """(index, format) of the proxy that answered last, for server-to-server traffic; None if none has."""
+        i = max(range(len(self.socks)), key=self.last_pong.__getitem__)
+        if time.time() - self.last_pong[i] > 3 * HEARTBEAT_INTERVAL:
+            return None
+        return i, self.wire[i]
+
+PROXIES = ["tcp://localhost:5559", "tcp://localhost:5561"]
+
+def serve(db_file, proxies=PROXIES, durability=DURABILITY, readers=READ_WORKERS, dump=None):
+    conn = init_db(db_file, durability)
     context = zmq.Context()
-    proxies = [
-        {"frontend": "tcp://localhost:5558", "backend": "tcp://localhost:5559"},
-        {"frontend": "tcp://localhost:5560", "backend": "tcp://localhost:5561"},
-    ]
 
-    sock = connect_to_proxy(context, proxies)
-    if not sock:
-        raise Exception("Could not connect to proxy!")
+    node = node_name(conn)
+    upstreams = Upstreams(context, proxies, node)
 
-    print(f"Server {server_number} ready with {db_file}")
+    replies = context.socket(zmq.PULL)
+    replies.bind("inproc://replies")
+    writes, reads, acks = queue.Queue(), queue.Queue(), queue.Queue()
+    cache = ListCache()
+    metrics.gauge("server.queue.reads", reads.qsize)
+    metrics.gauge("server.queue.writes", writes.qsize)
+    metrics.gauge("server.cache", cache.stats)
+    threading.Thread(target=write_worker, args=(context, db_file, writes, durability, cache), daemon=True).start()
+    for _ in range(readers):
+        threading.Thread(target=read_worker, args=(context, db_file, reads, cache), daemon=True).start()
+    threading.Thread(target=pump_worker, args=(context, db_file, durability, upstreams, acks), daemon=True).start()
+
+    print(f"Server ready with {db_file} ({readers} readers, durability {durability}), proxies: {', '.join(proxies)}")
     poller = zmq.Poller()
-    poller.register(sock, zmq.POLLIN)
+    for sock in upstreams.socks:
+        poller.register(sock, zmq.POLLIN)
+    poller.register(replies, zmq.POLLIN)
 
     last_ping = 0
+    next_dump = 0
     while True:
         try:
             now = time.time()
-            if now - last_ping > 3:
-                sock.send_json({"op": "ping"})
+            if now - last_ping > HEARTBEAT_INTERVAL:
+                upstreams.ping()
                 last_ping = now
+            if dump and now >= next_dump:
+                metrics.dump(dump)
+                next_dump = now + DUMP_INTERVAL
 
             socks = dict(poller.poll(1000))
-            if socks.get(sock) == zmq.POLLIN:
-                msg = sock.recv_multipart()
-                client_id = msg[0]
-                req = json.loads(msg[-1].decode())
-                reply = handle_request(conn, req)
-                sock.send_multipart([client_id, json.dumps(reply).encode()])
+            if socks.get(replies) == zmq.POLLIN:
+                while replies.poll(0):
+                    upstreams.send_multipart(replies.recv_multipart())
+
+            for i, sock in enumerate(upstreams.socks):
+                if socks.get(sock) != zmq.POLLIN:
+                    continue
+                origin = bytes([i])
+                while sock.poll(0):
+                    msg = sock.recv_multipart()
+                    if len(msg) == 1:
+                        # Addressed to this server itself: a pong or a relayed handoff ack.
+                        reply = decode(msg[0])
+                        if reply.get("status") == "pong":
+                            upstreams.pong(i, reply)
+                        else:
+                            acks.put(reply)
+                        continue
+                    route = [origin, msg[0]]
+                    fmt = format_of(msg[-1])
+                    with metrics.timer("server.decode"):
+                        req = decode(msg[-1])
+                    stamp(req, "server.recv")
+                    metrics.inc(f"server.requests.{req.get('op')}")
+                    if not from_proxy(msg[0]) and names_server_op(req):
+                        send_reply(upstreams, route, req, {"status": "error", "message": "Not allowed"}, fmt)
+                        continue
+                    if req.get("op") == "metrics":
+                        send_reply(upstreams, route, req, dict(metrics.snapshot(), status="ok", node=node), fmt)
+                        continue
+                    if is_first_page(req):
+                        entry = cache.get((req.get("list_id"), fmt))
+                        if entry is not None:
+                            send_cached(upstreams, route, req, entry, fmt)
+                            continue
+                    (reads if is_read(req) else writes).put((route, req, fmt, time.perf_counter()))
 
         except KeyboardInterrupt:
             print("\nServer shutting down...")
@@ -138,5 +684,22 @@ def main():
         except Exception as e:
             print(f"Error: {e}")
 
+def main():
+    parser = argparse.ArgumentParser(description="Run a storage server. Asks for its number if none is given.")
+    parser.add_argument("number", nargs="?", type=int, help="server number; the store is server<number>.db")
+    parser.add_argument("--db", help="store file, instead of server<number>.db")
+    parser.add_argument("--proxy", action="append", metavar="BACKEND",
+                        help="server-side address of a proxy; repeat for each (default: the two local proxies)")
+    parser.add_argument("--durability", choices=sorted(SYNC_LEVELS), default=DURABILITY)
+    parser.add_argument("--readers", type=int, default=READ_WORKERS)
+    parser.add_argument("--metrics", metavar="FILE", help=f"dump metrics to FILE every {DUMP_INTERVAL:g}s")
+    args = parser.parse_args()
+
+    db_file = args.db
+    if db_file is None:
+        number = args.number if args.number is not None else int(input("Server number: "))
+        db_file = f"server{number}.db"
+    serve(db_file, args.proxy or PROXIES, args.durability, args.readers, args.metrics)
+
 if __name__ == "__main__":
     main()
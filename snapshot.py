@@ -0,0 +1,145 @@
+import json
+import zlib
+import time
+import base64
+import hashlib
+import crdt
+
+# Bulk transfer of whole lists between servers.
+#
+# A snapshot holds the lists a rebalance moves to one node, with the CRDT
+# state of every item in them, tombstones included. The sender splits it into
+# chunks of at most CHUNK_ITEMS items, each compressed JSON with its own
+# checksum, and relays them through the proxy as "snapshot" requests. The
+# receiver stages chunks as they arrive. The last one carries a digest over
+# all chunk checksums; once every chunk is present and the digest matches, the
+# whole snapshot is imported in that request's transaction, so an import is
+# all or nothing.
+#
+# Import merges into what the receiver already has, so a stale node is
+# brought up to date and a repeated snapshot changes nothing. Items the
+# receiver has never seen skip the merge and are written with executemany.
+
+CHUNK_ITEMS = 5000
+STAGE_TTL = 3600  # staged chunks of snapshots that never completed are dropped after this long
+
+
+def init_staging(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS snapshot_chunks (
+                    id TEXT,
+                    seq INTEGER,
+                    data TEXT,
+                    received_at REAL,
+                    PRIMARY KEY(id, seq))''')
+
+
+def checksum(data):
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def digest(checksums):
+    return hashlib.blake2b("".join(checksums).encode(), digest_size=16).hexdigest()
+
+
+def _pack(lists, items):
+    body = json.dumps({"lists": lists, "items": items}, separators=(",", ":")).encode()
+    return base64.b64encode(zlib.compress(body)).decode()
+
+
+def _unpack(data):
+    return json.loads(zlib.decompress(base64.b64decode(data)))
+
+
+def export(c, list_ids, snapshot_id):
+    """The snapshot of the given lists as payloads of "snapshot" requests, in order."""
+    chunks = []
+    lists, items = [], []
+    for start in range(0, len(list_ids), 500):
+        batch = list_ids[start:start + 500]
+        marks = ",".join("?" * len(batch))
+        c.execute(f"SELECT id FROM shopping_lists WHERE id IN ({marks})", batch)
+        present = {row[0] for row in c.fetchall()}
+        for list_id in batch:
+            if list_id in present:
+                lists.append(list_id)
+        c.execute(f"SELECT list_id, name, state FROM item_state WHERE list_id IN ({marks}) ORDER BY list_id, name", batch)
+        for row in c.fetchall():
+            items.append(row)
+            if len(items) >= CHUNK_ITEMS:
+                chunks.append(_pack(lists, items))
+                lists, items = [], []
+    if lists or items or not chunks:
+        chunks.append(_pack(lists, items))
+
+    sums = [checksum(data) for data in chunks]
+    payloads = [{"id": snapshot_id, "seq": seq, "total": len(chunks), "checksum": sums[seq], "data": data}
+                for seq, data in enumerate(chunks)]
+    payloads[-1]["digest"] = digest(sums)
+    return payloads
+
+
+def receive(c, payload, merge):
+    """Stage one chunk; on the last one, check the snapshot and import it.
+
+    merge(c, list_id, name, state) applies a state to an item that already
+    exists here. Returns the reply; an import also lists the lists it wrote
+    under "written"."""
+    snapshot_id, seq, total = payload["id"], payload["seq"], payload["total"]
+    if checksum(payload["data"]) != payload["checksum"]:
+        return {"status": "error", "message": f"Snapshot {snapshot_id} chunk {seq}: checksum mismatch"}
+    now = time.time()
+    c.execute("DELETE FROM snapshot_chunks WHERE received_at < ?", (now - STAGE_TTL,))
+    c.execute("INSERT OR REPLACE INTO snapshot_chunks(id, seq, data, received_at) VALUES (?, ?, ?, ?)",
+              (snapshot_id, seq, payload["data"], now))
+    if "digest" not in payload:
+        return {"status": "ok", "staged": seq}
+
+    c.execute("SELECT seq, data FROM snapshot_chunks WHERE id=? ORDER BY seq", (snapshot_id,))
+    rows = c.fetchall()
+    c.execute("DELETE FROM snapshot_chunks WHERE id=?", (snapshot_id,))
+    if [seq for seq, _ in rows] != list(range(total)):
+        return {"status": "error", "message": f"Snapshot {snapshot_id}: {total - len(rows)} chunks missing"}
+    if digest([checksum(data) for _, data in rows]) != payload["digest"]:
+        return {"status": "error", "message": f"Snapshot {snapshot_id}: digest mismatch"}
+
+    written = set()
+    count = 0
+    for _, data in rows:
+        chunk = _unpack(data)
+        written.update(chunk["lists"])
+        written.update(list_id for list_id, _, _ in chunk["items"])
+        count += import_chunk(c, chunk["lists"], chunk["items"], merge)
+    return {"status": "ok", "imported": count, "written": sorted(written)}
+
+
+def import_chunk(c, lists, items, merge):
+    """Write one chunk's lists and items. Returns the number of items."""
+    list_ids = set(lists) | {list_id for list_id, _, _ in items}
+    # A list new to this node is logged as a change; one it already had is left alone.
+    c.executemany("INSERT OR IGNORE INTO shopping_lists(id) VALUES (?)", [(list_id,) for list_id in list_ids])
+    c.executemany("INSERT OR IGNORE INTO changes(list_id, name) VALUES (?, '')", [(list_id,) for list_id in list_ids])
+
+    existing = set()
+    for list_id in list_ids:
+        c.execute("SELECT name FROM item_state WHERE list_id=?", (list_id,))
+        existing.update((list_id, name) for (name,) in c.fetchall())
+
+    fresh_state, fresh_items, versions = [], [], {}
+    for list_id, name, state in items:
+        if (list_id, name) in existing:
+            merge(c, list_id, name, json.loads(state))
+            continue
+        fresh_state.append((list_id, name, state))
+        item = json.loads(state)
+        if crdt.is_present(item):
+            current, target = crdt.values(item)
+            fresh_items.append((list_id, name, current, target))
+            versions[list_id] = versions.get(list_id, 0) ^ crdt.row_digest(name, current, target)
+    c.executemany("INSERT INTO item_state(list_id, name, state) VALUES (?, ?, ?)", fresh_state)
+    c.executemany("INSERT OR REPLACE INTO items(list_id, name, current_qtd, target_qtd, acquired_flag) VALUES (?, ?, ?, ?, 0)",
+                  fresh_items)
+    for list_id, change in versions.items():
+        crdt.bump_version(c, list_id, change)
+    c.executemany("INSERT OR REPLACE INTO changes(list_id, name) VALUES (?, ?)",
+                  [(list_id, name) for list_id, name, _ in fresh_state])
+    return len(items)
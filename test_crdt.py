@@ -0,0 +1,47 @@
+import itertools
+import crdt
+
+
+def added(replica, current, target):
+    return crdt.merge(crdt.new_item(), crdt.add_delta(crdt.new_item(), replica, f"{replica}:1", current, target))
+
+
+def states():
+    """A few replicas' concurrent edits of one item, each a valid state."""
+    base = added("a", 1, 4)
+    removed = crdt.merge(base, crdt.remove_delta(base))
+    readded = crdt.merge(removed, crdt.add_delta(removed, "b", "b:1", 2, 4))
+    updated = crdt.merge(base, crdt.set_delta(base, "c", 3, 5))
+    return [crdt.new_item(), base, removed, readded, updated]
+
+
+def test_merge_is_commutative():
+    for a, b in itertools.product(states(), repeat=2):
+        assert crdt.merge(a, b) == crdt.merge(b, a)
+
+
+def test_merge_is_associative():
+    for a, b, c in itertools.product(states(), repeat=3):
+        assert crdt.merge(crdt.merge(a, b), c) == crdt.merge(a, crdt.merge(b, c))
+
+
+def test_merge_is_idempotent():
+    for a, b in itertools.product(states(), repeat=2):
+        merged = crdt.merge(a, b)
+        assert crdt.merge(merged, a) == merged
+        assert crdt.merge(merged, merged) == merged
+
+
+def test_concurrent_add_wins_over_remove():
+    base = added("a", 1, 1)
+    remove = crdt.remove_delta(base)
+    add = crdt.add_delta(base, "b", "b:1", 1, 1)
+    assert crdt.is_present(crdt.merge(crdt.merge(base, remove), add))
+    assert not crdt.is_present(crdt.merge(base, remove))
+
+
+def test_concurrent_updates_add_up():
+    base = added("a", 1, 5)
+    one = crdt.set_delta(base, "b", 2, 5)
+    other = crdt.set_delta(base, "c", 3, 5)
+    assert crdt.values(crdt.merge(crdt.merge(base, one), other)) == (4, 5)
@@ -0,0 +1,28 @@
+import pytest
+import protocol
+from protocol import plain_ok, encode, JSON, MSGPACK
+
+FORMATS = [JSON] + ([MSGPACK] if protocol.msgpack else [])
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_plain_ok_replies(fmt):
+    assert plain_ok(encode({"status": "ok"}, fmt))
+    assert plain_ok(encode({"status": "ok", "req_id": "r1", "list": {"id": "a", "items": []}}, fmt))
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+@pytest.mark.parametrize("reply", [
+    {"status": "error", "message": "List not found"},
+    {"status": "not_modified", "version": "00"},
+    {"status": "okay"},
+    {"status": "ok", "trace": [["server.recv", 0.0]]},
+    {"req_id": "r1", "status": "ok"},
+])
+def test_plain_ok_rejects(fmt, reply):
+    assert not plain_ok(encode(reply, fmt))
+
+
+def test_plain_ok_on_a_string_value():
+    # "trace" inside a value is mistaken for the key; the reply is then decoded, which is safe.
+    assert not plain_ok(encode({"status": "ok", "list": {"id": "trace", "items": []}}))
@@ -0,0 +1,50 @@
+import random
+from proxy import merge_list_pages
+
+
+def server_page(held, after, limit):
+    """A server's list_all_lists reply, as server.apply_op pages it."""
+    lists = sorted(l for l in held if l > after)
+    reply = {"status": "ok", "lists": lists[:limit]}
+    if len(lists) > limit:
+        reply["next"] = lists[limit - 1]
+    return reply
+
+
+def page_through(servers, limit):
+    seen, after = [], ""
+    while True:
+        page = merge_list_pages([server_page(held, after, limit) for held in servers])
+        assert page["status"] == "ok" and "incomplete" not in page
+        seen.extend(page["lists"])
+        if "next" not in page:
+            return seen
+        assert page["next"] == page["lists"][-1]
+        after = page["next"]
+
+
+def test_pages_cover_every_list_once():
+    rng = random.Random(7)
+    names = [f"list-{i:04d}" for i in range(300)]
+    servers = [set(), set(), set()]
+    for name in names:
+        # Two replicas each, as with N=2.
+        for held in rng.sample(servers, 2):
+            held.add(name)
+    for limit in (1, 7, 50, 299, 300, 1000):
+        assert page_through(servers, limit) == names
+
+
+def test_uneven_servers():
+    servers = [{"a", "b", "c", "d", "e", "f"}, {"x"}, set()]
+    assert page_through(servers, 2) == ["a", "b", "c", "d", "e", "f", "x"]
+
+
+def test_missing_servers_mark_the_page_incomplete():
+    page = merge_list_pages([{"status": "ok", "lists": ["a", "b"]}, {"status": "timeout"}])
+    assert page == {"status": "ok", "lists": ["a", "b"], "incomplete": True}
+
+
+def test_no_answers():
+    assert merge_list_pages([{"status": "timeout"}, {"status": "timeout"}]) == {"status": "timeout"}
+    assert merge_list_pages([])["status"] == "error"
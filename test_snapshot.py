@@ -0,0 +1,82 @@
+import pytest
+import server
+import snapshot
+
+
+def store(tmp_path, name):
+    return server.init_db(str(tmp_path / name)).cursor()
+
+
+def fill(c, lists, items):
+    for l in range(lists):
+        server.apply_op(c, "merge", f"L{l}", {"items": {}})
+        for i in range(items):
+            server.apply_op(c, "create_item", f"L{l}", {"item_name": f"i{i}", "current": i, "total": items})
+
+
+def receive_all(c, payloads):
+    return [snapshot.receive(c, payload, server.apply_delta) for payload in payloads]
+
+
+def dump(c):
+    c.execute("SELECT id, version FROM shopping_lists ORDER BY id")
+    lists = c.fetchall()
+    c.execute("SELECT list_id, name, state FROM item_state ORDER BY list_id, name")
+    return lists, c.fetchall()
+
+
+@pytest.fixture
+def chunked(monkeypatch):
+    monkeypatch.setattr(snapshot, "CHUNK_ITEMS", 7)
+
+
+def test_round_trip(tmp_path, chunked):
+    src, dst = store(tmp_path, "src.db"), store(tmp_path, "dst.db")
+    fill(src, 3, 10)
+    server.apply_op(src, "merge", "empty", {"items": {}})
+    payloads = snapshot.export(src, ["L0", "L1", "L2", "empty", "missing"], "s1")
+    assert len(payloads) > 1 and "digest" in payloads[-1]
+
+    replies = receive_all(dst, payloads)
+    assert all(r == {"status": "ok", "staged": p["seq"]} for r, p in zip(replies, payloads[:-1]))
+    assert replies[-1] == {"status": "ok", "imported": 30, "written": ["L0", "L1", "L2", "empty"]}
+    assert dump(dst) == dump(src)
+
+
+def test_import_merges_into_existing_items(tmp_path, chunked):
+    src, dst = store(tmp_path, "src.db"), store(tmp_path, "dst.db")
+    fill(src, 1, 5)
+    receive_all(dst, snapshot.export(src, ["L0"], "s1"))
+    server.apply_op(src, "update_item", "L0", {"item_name": "i1", "current": 4, "total": 5})
+    server.apply_op(src, "delete_item", "L0", {"item_name": "i2"})
+    replies = receive_all(dst, snapshot.export(src, ["L0"], "s2"))
+    assert replies[-1]["imported"] == 5
+    assert dump(dst) == dump(src)
+    # A repeated snapshot changes nothing.
+    receive_all(dst, snapshot.export(src, ["L0"], "s3"))
+    assert dump(dst) == dump(src)
+
+
+def test_damaged_chunk_is_rejected(tmp_path, chunked):
+    src, dst = store(tmp_path, "src.db"), store(tmp_path, "dst.db")
+    fill(src, 2, 10)
+    payloads = snapshot.export(src, ["L0", "L1"], "s1")
+    payloads[0]["data"] = payloads[1]["data"]
+    reply = snapshot.receive(dst, payloads[0], server.apply_delta)
+    assert reply["status"] == "error" and "checksum mismatch" in reply["message"]
+    # The rejected chunk was not staged, so the snapshot cannot complete.
+    reply = receive_all(dst, payloads[1:])[-1]
+    assert reply["status"] == "error" and "1 chunks missing" in reply["message"]
+    assert dump(dst) == ([], [])
+
+
+def test_digest_mismatch_is_rejected(tmp_path, chunked):
+    src, dst = store(tmp_path, "src.db"), store(tmp_path, "dst.db")
+    fill(src, 2, 10)
+    first = snapshot.export(src, ["L0", "L1"], "s1")
+    # Chunks that are each intact but come from another snapshot under the same id.
+    server.apply_op(src, "update_item", "L0", {"item_name": "i0", "current": 5, "total": 10})
+    second = snapshot.export(src, ["L0", "L1"], "s1")
+    reply = receive_all(dst, first[:-1] + second[-1:])[-1]
+    assert reply["status"] == "error" and "digest mismatch" in reply["message"]
+    assert dump(dst) == ([], [])